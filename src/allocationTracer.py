@@ -0,0 +1,77 @@
+import gc
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class AllocationTracer(object):
+    """
+    基于tracemalloc的内存分配统计:各预处理步骤新分配的次数及字节数,每帧处理的峰值内存增量,处理耗时的均值及抖动,
+    垃圾回收次数。未启用时不启动tracemalloc,各统计点几乎没有开销
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}  # 步骤名称 -> [分配次数, 字节数]
+        self.frames = 0  # 统计的帧数
+        self.peaks = []  # 每帧的峰值内存增量
+        self.latencies = []  # 每帧的处理耗时
+        self.frame_start = None  # 当前帧开始时的(已分配内存, 时间)
+        self.collections = None  # 开始统计时的垃圾回收次数
+
+    def start(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.enabled and self.collections is None:
+            self.collections = sum(stat['collections'] for stat in gc.get_stats())
+
+    @contextmanager
+    def stage(self, name):
+        """
+        统计步骤内新分配且未释放的内存,即步骤输出的数组,每个步骤应只包含一次调用
+        :param name: 步骤名称
+        :return:
+        """
+        if not self.enabled:
+            yield
+            return
+        before = tracemalloc.get_traced_memory()[0]
+        yield
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        stage = self.stages.setdefault(name, [0, 0])
+        if allocated > 1024:  # 忽略Python对象本身,只统计图像数据
+            stage[0] += 1
+            stage[1] += allocated
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.start()
+        tracemalloc.reset_peak()
+        self.frame_start = (tracemalloc.get_traced_memory()[0], time.perf_counter())
+
+    def end_frame(self):
+        if not self.enabled or self.frame_start is None:
+            return
+        memory, start = self.frame_start
+        self.latencies.append(time.perf_counter() - start)
+        self.peaks.append(tracemalloc.get_traced_memory()[1] - memory)
+        self.frames += 1
+        self.frame_start = None
+
+    def stats(self):
+        """
+        :return stats: 每帧预处理分配次数及KB数,每帧峰值内存增量KB,处理耗时均值及标准差ms,垃圾回收次数
+        """
+        frames = max(self.frames, 1)
+        collections = sum(stat['collections'] for stat in gc.get_stats()) - (self.collections or 0)
+        return {'frames': self.frames,
+                'allocations': sum(count for count, size in self.stages.values()) / frames,
+                'allocated_kb': sum(size for count, size in self.stages.values()) / frames / 1024,
+                'stages': {name: (count / frames, size / frames / 1024) for name, (count, size) in self.stages.items()},
+                'peak_kb': float(np.mean(self.peaks)) / 1024 if self.peaks else 0.0,
+                'latency_ms': float(np.mean(self.latencies)) * 1000 if self.latencies else 0.0,
+                'jitter_ms': float(np.std(self.latencies)) * 1000 if self.latencies else 0.0,
+                'collections': collections if self.collections is not None else 0}
@@ -0,0 +1,279 @@
+import argparse
+import queue
+import time
+
+import cv2
+import numpy as np
+from src.detector import create_detector
+from src.lbph import LBPHRecognizer
+from src.tracker import iou, DetectionRegion
+
+
+def iter_synthetic_faces(count, subjects, rng, size=200, chunk_size=1000):
+    """
+    分批生成测试用的灰度人脸:每个用户一张平滑程度不同的纹理,样本为其随机平移,改变亮度对比度并加少量噪声。
+    样本数量较大时无需一次全部放入内存
+    :param count: 样本数量
+    :param subjects: 用户数量
+    :param rng: np.random.Generator
+    :param size: 图像边长
+    :param chunk_size: 每批样本数量
+    :returns faces,labels: 每批 (chunk_size, size, size) uint8, (chunk_size,) int32
+    """
+    margin = 20
+    bases = [cv2.GaussianBlur(rng.integers(0, 256, (size + margin, size + margin), dtype=np.uint8), (0, 0),
+                              rng.uniform(1.5, 4)) for _ in range(subjects)]
+    labels = np.arange(count, dtype=np.int32) % subjects
+    for start in range(0, count, chunk_size):
+        chunk_labels = labels[start:start + chunk_size]
+        faces = np.empty((len(chunk_labels), size, size), np.uint8)
+        for i, label in enumerate(chunk_labels):
+            dx, dy = rng.integers(0, margin, 2)
+            gain, bias = rng.uniform(0.8, 1.2), rng.uniform(-20, 20)
+            face = bases[label][dy:dy + size, dx:dx + size] * gain + bias + rng.normal(0, 2, (size, size))
+            faces[i] = np.clip(face, 0, 255)
+        yield faces, chunk_labels
+
+
+def synthetic_faces(count, subjects, rng, size=200):
+    """
+    一次生成全部测试用的灰度人脸,与iter_synthetic_faces的结果相同
+    :param count: 样本数量
+    :param subjects: 用户数量
+    :param rng: np.random.Generator
+    :param size: 图像边长
+    :returns faces,labels: (count, size, size) uint8, (count,) int32
+    """
+    faces, labels = zip(*iter_synthetic_faces(count, subjects, rng, size, chunk_size=count))
+    return faces[0], labels[0]
+
+
+def benchmark_lbph(sizes, probe_count=32, seed=0):
+    """
+    对比LBPHFaceRecognizer与NumPy实现在不同样本数量下的识别耗时,人脸分批生成及训练,内存只保存两者的直方图
+    :param sizes: 样本数量列表
+    :param probe_count: 待识别人脸数量
+    :param seed: 随机种子
+    :return:
+    """
+    print('{:>8} {:>10} {:>10} {:>10} {:>14} {:>8} {:>10} {:>8}'.format(
+        'samples', 'gallery MB', 'opencv ms', 'numpy ms', 'numpy batch ms', 'speedup', 'agreement', 'refined'))
+    for size in sizes:
+        rng = np.random.default_rng(seed)
+        subjects = max(size // 200, 2)
+        opencv = cv2.face.LBPHFaceRecognizer_create()
+        engine = LBPHRecognizer()
+        histograms = np.empty((size, engine.histograms.shape[1]), np.float32)
+        gallery_labels = np.empty(size, np.int32)
+        probes = []
+        start = 0  # 当前批次第一个样本的下标
+        for faces, labels in iter_synthetic_faces(size + probe_count, subjects, rng):
+            count = min(max(size - start, 0), len(faces))  # 本批中属于样本库的数量,其余为待识别人脸
+            probes.extend(faces[count:])
+            if count:
+                if start:
+                    opencv.update(list(faces[:count]), labels[:count])
+                else:
+                    opencv.train(list(faces[:count]), labels[:count])
+                for i in range(0, count, engine.batch_size):
+                    histograms[start + i:start + min(i + engine.batch_size, count)] = engine.compute_histograms(
+                        faces[i:min(i + engine.batch_size, count)])
+                gallery_labels[start:start + count] = labels[:count]
+            start += len(faces)
+        engine.set_histograms(histograms, gallery_labels)
+        del histograms
+
+        start = time.perf_counter()
+        expected = [opencv.predict(probe) for probe in probes]
+        opencv_ms = (time.perf_counter() - start) * 1000 / probe_count
+        start = time.perf_counter()
+        single = [engine.predict(probe) for probe in probes]
+        numpy_ms = (time.perf_counter() - start) * 1000 / probe_count
+        engine.refined = 0
+        start = time.perf_counter()
+        batch = engine.predict_batch(probes)
+        batch_ms = (time.perf_counter() - start) * 1000 / probe_count
+
+        agreement = np.mean([a[0] == b[0] == c[0] for a, b, c in zip(expected, single, batch)])
+        gallery_mb = (engine.histograms.nbytes + engine.roots.nbytes) / 1024 / 1024
+        print('{:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>14.2f} {:>7.1f}x {:>10.0%} {:>8.0f}'.format(
+            size, gallery_mb, opencv_ms, numpy_ms, batch_ms, opencv_ms / batch_ms, agreement,
+            engine.refined / probe_count))
+
+
+def read_video(video, max_frames):
+    """
+    读取录制的视频,返回BGR原图,灰度图由调用方按需计算
+    :param video: 视频文件
+    :param max_frames: 最多读取的帧数
+    :return frames: 图像帧列表
+    """
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise FileNotFoundError(video)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def benchmark_detect(video, scales, max_frames=300, min_iou=0.5, roi=None):
+    """
+    人脸检测在不同缩放比例下的耗时及召回率,以原图整个画面检测到的人脸为基准
+    :param video: 录制的视频文件
+    :param scales: 缩放比例列表
+    :param max_frames: 最多读取的帧数
+    :param min_iou: 与基准人脸框的交并比不低于该值视为检测到
+    :param roi: 固定检测区域,None为全画面;同时使用FaceProcess配置的自适应区域
+    :return:
+    """
+    from src.faceProcess import FaceProcess
+
+    frames = read_video(video, max_frames)
+    grays = [cv2.equalizeHist(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)) for frame in frames]
+    face_process = FaceProcess(queue.Queue())
+    face_process.detect_scale = 1
+    face_process.region = DetectionRegion(full_scan_interval=1)
+    reference = [face_process.detect_faces(gray, frame) for gray, frame in zip(grays, frames)]
+    total = sum(len(faces) for faces in reference)
+    print('{} frames of {}x{}, {} faces at scale 1.'.format(len(grays), grays[0].shape[1] if grays else 0,
+                                                           grays[0].shape[0] if grays else 0, total))
+    print('{:>6} {:>12} {:>8} {:>8} {:>8}'.format('scale', 'detect ms', 'faces', 'recall', 'area'))
+    for scale in scales:
+        face_process.detect_scale = scale
+        face_process.region = DetectionRegion(roi, face_process.roi_margin, face_process.roi_growth,
+                                              face_process.full_scan_interval)
+        start = time.perf_counter()
+        detections = [face_process.detect_faces(gray, frame) for gray, frame in zip(grays, frames)]
+        detect_ms = (time.perf_counter() - start) * 1000 / max(len(grays), 1)
+        found = sum(any(iou(face, box) >= min_iou for box in boxes)
+                    for faces, boxes in zip(reference, detections) for face in faces)
+        print('{:>6.2f} {:>12.2f} {:>8} {:>8.1%} {:>8.0%}'.format(
+            scale, detect_ms, sum(len(boxes) for boxes in detections), found / max(total, 1),
+            face_process.region.stats()['scanned']))
+
+
+def benchmark_detectors(video, backends, reference='dnn', recall_target=0.95, max_frames=300, min_iou=0.5):
+    """
+    对比各检测后端的耗时及召回率,以参考后端在整个画面检测到的人脸为基准,选出满足召回率的最快后端
+    :param video: 录制的视频文件
+    :param backends: 后端名称列表
+    :param reference: 作为基准的后端
+    :param recall_target: 召回率要求
+    :param max_frames: 最多读取的帧数
+    :param min_iou: 与基准人脸框的交并比不低于该值视为检测到
+    :return fastest: 满足召回率的最快后端,没有时为None
+    """
+    from src.faceProcess import FaceProcess
+
+    frames = read_video(video, max_frames)
+    # 级联分类器使用均衡化后的灰度图,DNN使用原图
+    grays = [cv2.equalizeHist(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)) for frame in frames]
+    face_process = FaceProcess(queue.Queue())
+    face_process.region = DetectionRegion(full_scan_interval=1)
+
+    def run(backend):
+        face_process.detector = create_detector(backend)
+        start = time.perf_counter()
+        detections = [face_process.detect_faces(gray, frame) for gray, frame in zip(grays, frames)]
+        return detections, (time.perf_counter() - start) * 1000 / max(len(grays), 1)
+
+    # 参考后端缺少模型文件时退回级联分类器
+    reference_detections = None
+    for candidate in dict.fromkeys([reference, 'haar']):
+        try:
+            reference_detections, _ = run(candidate)
+        except (FileNotFoundError, cv2.error) as e:
+            print('reference backend {} unavailable: {}'.format(candidate, e))
+            continue
+        reference = candidate
+        break
+    if reference_detections is None:
+        return None
+    total = sum(len(faces) for faces in reference_detections)
+    print('{} frames, {} faces found by {} at scale {}.'.format(len(grays), total, reference,
+                                                                face_process.detect_scale))
+    print('{:>8} {:>12} {:>8} {:>8}'.format('backend', 'detect ms', 'faces', 'recall'))
+    fastest, fastest_ms = None, float('inf')
+    for backend in backends:
+        try:
+            detections, detect_ms = run(backend)
+        except (FileNotFoundError, cv2.error) as e:
+            print('{:>8} skipped: {}'.format(backend, e))
+            continue
+        found = sum(any(iou(face, box) >= min_iou for box in boxes)
+                    for faces, boxes in zip(reference_detections, detections) for face in faces)
+        recall = found / max(total, 1)
+        print('{:>8} {:>12.2f} {:>8} {:>8.1%}'.format(backend, detect_ms, sum(len(boxes) for boxes in detections),
+                                                     recall))
+        if recall >= recall_target and detect_ms < fastest_ms:
+            fastest, fastest_ms = backend, detect_ms
+    print('fastest backend with recall >= {:.0%}: {}'.format(recall_target, fastest))
+    return fastest
+
+
+def benchmark_alloc(video, max_frames=300):
+    """
+    按签到流程处理录制的视频,统计每帧预处理的内存分配及处理耗时抖动
+    :param video: 录制的视频文件
+    :param max_frames: 最多读取的帧数
+    :return:
+    """
+    from src.faceProcess import FaceProcess
+    from src.allocationTracer import AllocationTracer
+
+    frames = read_video(video, max_frames)
+    face_process = FaceProcess(queue.Queue())
+    face_process.motion_gate = None
+    face_process.sign = lambda stu_id: None  # 不写入签到数据库
+    face_process.face_detect_update(frames[0].copy())  # 加载检测器及模型
+    face_process.tracer = AllocationTracer(True)
+    face_process.tracer.start()
+    for frame in frames:
+        face_process.tracer.begin_frame()
+        face_process.face_detect_update(frame)
+        face_process.tracer.end_frame()
+    stats = face_process.tracer.stats()
+    print('{frames} frames, preprocess allocations per frame: {allocations:.1f}, {allocated_kb:.0f} KB, '
+          'peak memory {peak_kb:.0f} KB per frame, latency {latency_ms:.2f} ± {jitter_ms:.2f} ms, '
+          '{collections} gc collections.'.format(**stats))
+    for name, (count, size) in sorted(stats['stages'].items()):
+        print('{:>10} {:>6.2f} allocations {:>8.1f} KB per frame'.format(name, count, size))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    lbph_parser = subparsers.add_parser('lbph', help='LBPH识别: OpenCV与NumPy实现对比')
+    lbph_parser.add_argument('--sizes', default='100,1000,10000',
+                             help='样本数量,逗号分隔;每个样本约64KB,OpenCV保存一份,NumPy保存直方图及其平方根两份,'
+                                  '100000个样本约需20GB内存')
+    lbph_parser.add_argument('--probes', type=int, default=32, help='待识别人脸数量')
+    detect_parser = subparsers.add_parser('detect', help='人脸检测: 不同缩放比例的耗时及召回率')
+    detect_parser.add_argument('video', help='录制的视频文件')
+    detect_parser.add_argument('--scales', default='1,0.75,0.5,0.35,0.25', help='缩放比例,逗号分隔')
+    detect_parser.add_argument('--frames', type=int, default=300, help='最多读取的帧数')
+    detect_parser.add_argument('--roi', help='固定检测区域x,y,w,h,相对画面宽高的比例,默认全画面')
+    detectors_parser = subparsers.add_parser('detectors', help='人脸检测: 各检测后端的耗时及召回率')
+    detectors_parser.add_argument('video', help='录制的视频文件')
+    detectors_parser.add_argument('--backends', default='haar,lbp,dnn', help='检测后端,逗号分隔')
+    detectors_parser.add_argument('--reference', default='dnn', help='作为基准的后端')
+    detectors_parser.add_argument('--recall', type=float, default=0.95, help='召回率要求')
+    detectors_parser.add_argument('--frames', type=int, default=300, help='最多读取的帧数')
+    alloc_parser = subparsers.add_parser('alloc', help='签到流程每帧的内存分配及耗时抖动')
+    alloc_parser.add_argument('video', help='录制的视频文件')
+    alloc_parser.add_argument('--frames', type=int, default=300, help='最多读取的帧数')
+    args = parser.parse_args()
+    if args.command == 'lbph':
+        benchmark_lbph([int(size) for size in args.sizes.split(',')], args.probes)
+    elif args.command == 'detect':
+        benchmark_detect(args.video, [float(scale) for scale in args.scales.split(',')], args.frames,
+                         roi=[float(value) for value in args.roi.split(',')] if args.roi else None)
+    elif args.command == 'detectors':
+        benchmark_detectors(args.video, args.backends.split(','), args.reference, args.recall, args.frames)
+    elif args.command == 'alloc':
+        benchmark_alloc(args.video, args.frames)
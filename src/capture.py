@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class FrameBuffer(object):
+    """
+    最新帧环形缓冲区,写满时丢弃最旧的帧,读取时只取最新帧
+    """
+
+    def __init__(self, size=2):
+        self.frames = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.seq = 0  # 帧序号
+        self.captured = 0  # 采集帧数
+        self.processed = 0  # 处理帧数
+        self.dropped = 0  # 丢弃帧数
+
+    def put(self, frame):
+        """
+        写入一帧,缓冲区已满时最旧的帧被丢弃
+        :param frame: 图像帧
+        :return:
+        """
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.seq += 1
+            self.captured += 1
+            self.frames.append((self.seq, frame))
+            self.condition.notify_all()
+
+    def get_latest(self, timeout=None):
+        """
+        取出最新帧,其余未处理的旧帧计为丢弃
+        :param timeout: 等待新帧的时间,0为不等待,None为一直等待
+        :returns seq,frame: 帧序号,图像帧;无新帧时为None,None
+        """
+        with self.condition:
+            if not self.frames and timeout != 0:
+                self.condition.wait(timeout)
+            if not self.frames:
+                return None, None
+            seq, frame = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            return seq, frame
+
+    def mark_processed(self):
+        with self.condition:
+            self.processed += 1
+
+    def clear(self):
+        with self.condition:
+            self.frames.clear()
+
+    def stats(self):
+        """
+        :return stats: 采集,处理,丢弃帧数
+        """
+        with self.condition:
+            return {'captured': self.captured, 'processed': self.processed, 'dropped': self.dropped}
+
+
+class CaptureThread(threading.Thread):
+    """
+    采集线程,持续读取摄像头并写入缓冲区
+    """
+
+    def __init__(self, cap, frame_buffer):
+        super(CaptureThread, self).__init__(daemon=True)
+        self.cap = cap
+        self.frame_buffer = frame_buffer
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                time.sleep(0.01)
+                continue
+            self.frame_buffer.put(frame)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=1)
+
+
+class FrameWorker(threading.Thread):
+    """
+    处理线程,从缓冲区取最新帧处理,保存最新的处理结果供界面绘制
+    """
+
+    def __init__(self, frame_buffer, process, log_queue, motion_gate=None, tracer=None):
+        super(FrameWorker, self).__init__(daemon=True)
+        self.frame_buffer = frame_buffer
+        self.process = process  # 处理函数,输入图像帧,返回处理后的图像帧,暂无结果时返回None
+        self.log_queue = log_queue
+        self.motion_gate = motion_gate  # 运动检测,空闲时降低处理帧率
+        self.tracer = tracer  # 内存分配统计
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.result = (0, None)  # 最新处理结果:帧序号,图像帧
+
+    def run(self):
+        while not self.stop_event.is_set():
+            seq, frame = self.frame_buffer.get_latest(timeout=0.1)
+            if frame is None:
+                continue
+            if self.tracer is not None:
+                self.tracer.begin_frame()
+            try:
+                frame = self.process(frame)
+            except Exception as e:
+                self.log_queue.put('Error: failed to process frame {}.'.format(seq))
+                continue
+            finally:
+                if self.tracer is not None:
+                    self.tracer.end_frame()
+            if frame is None:
+                continue
+            self.frame_buffer.mark_processed()
+            with self.lock:
+                self.result = (seq, frame)
+            if self.motion_gate is not None and self.motion_gate.is_idle:
+                self.stop_event.wait(self.motion_gate.idle_interval)
+
+    def latest_result(self):
+        """
+        :returns seq,frame: 最新处理完成的帧序号及图像帧
+        """
+        with self.lock:
+            return self.result
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=1)
+
+
+def open_camera(cap, index=cv2.CAP_DSHOW + 0):
+    """
+    打开摄像头,驱动缓冲只保留一帧,避免延迟累积
+    :param cap: cv2.VideoCapture
+    :param index: 摄像头编号
+    :return:
+    """
+    if not cap.isOpened():
+        cap.open(index)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
@@ -7,7 +7,7 @@ import multiprocessing
 from datetime import datetime
 
 from PyQt5 import QtWidgets
-from PyQt5.QtWidgets import QMainWindow, QApplication, QMessageBox
+from PyQt5.QtWidgets import QMainWindow, QApplication, QMessageBox, QMenu
 from PyQt5.QtCore import pyqtSignal, QTimer
 from PyQt5.QtGui import QIcon, QTextCursor, QFontDatabase, QFont
 from PyQt5.uic import loadUi
@@ -37,6 +37,12 @@ class CoreUI(QMainWindow):
 
         # 点击签到
         self.signButton.clicked.connect(self.start_camera_sign)
+        # 选择班级,只识别选中班级的用户
+        self.active_classes = None  # None为全部班级
+        self.class_menu = QMenu(self)
+        self.class_menu.triggered.connect(self.select_classes)
+        self.classButton.setMenu(self.class_menu)
+        self.load_classes()
         # 图像处理
         self.face_process = None
         self.is_camera_ok = None
@@ -60,9 +66,48 @@ class CoreUI(QMainWindow):
         打开摄像头
         :return:
         '''
+        if self.face_process:
+            self.face_process.stop_camera()
         self.face_process = FaceProcess(self.log_queue)
+        self.face_process.active_classes = self.active_classes
         self.is_camera_ok = self.face_process.start_camera(self.signButton, self.timer)
 
+    def load_classes(self):
+        """
+        从数据库读取班级,生成班级菜单
+        :return:
+        """
+        self.class_menu.clear()
+        action = self.class_menu.addAction('全部班级')
+        action.setCheckable(True)
+        action.setChecked(True)
+        self.class_menu.addSeparator()
+        for class_ in self.db.query_classes():
+            action = self.class_menu.addAction(class_)
+            action.setCheckable(True)
+            action.setData(class_)
+
+    def select_classes(self, action):
+        """
+        选择班级,可多选,选择全部班级或取消全部选择时识别所有用户
+        :param action: 点击的菜单项
+        :return:
+        """
+        actions = self.class_menu.actions()
+        class_actions = [item for item in actions if item.data()]
+        if not action.data() or not any(item.isChecked() for item in class_actions):
+            for item in class_actions:
+                item.setChecked(False)
+            actions[0].setChecked(True)
+            self.active_classes = None
+            self.classButton.setText('全部班级')
+        else:
+            actions[0].setChecked(False)
+            self.active_classes = [item.data() for item in class_actions if item.isChecked()]
+            self.classButton.setText(', '.join(self.active_classes))
+        if self.face_process:
+            self.face_process.set_active_classes(self.active_classes)
+
     def update_frame_set(self):
         """
         更新显示画面
@@ -148,7 +193,7 @@ class CoreUI(QMainWindow):
         if ret == QtWidgets.QMessageBox.Yes:
             self.timer.stop()
             if  self.face_process:
-                self.face_process.cap.release()
+                self.face_process.stop_camera()
             event.accept()
         else:
             event.ignore()
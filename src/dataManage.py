@@ -5,8 +5,6 @@ from PyQt5.uic import loadUi
 
 import logging
 import logging.config
-import os
-import shutil
 import sys
 import threading
 import multiprocessing
@@ -17,6 +15,8 @@ from PyQt5 import QtWidgets
 
 from src.database import DataBase
 from src.faceProcess import FaceProcess
+from src.faceStore import FaceStore
+from src.trainThread import TrainThread
 
 
 class DataManageUI(QWidget):
@@ -55,6 +55,8 @@ class DataManageUI(QWidget):
 
         # 训练人脸数据
         self.face_process = FaceProcess(self.log_queue)
+        self.train_thread = None  # 后台训练线程
+        self.remove_threads = []  # 后台从模型中删除用户的线程,运行结束前保留引用
         self.trainButton.clicked.connect(self.train_set)
 
         # 系统日志
@@ -121,9 +123,12 @@ class DataManageUI(QWidget):
             is_deleted1 = self.db.delete_user(stu_id, './FaceBase.db')
             is_deleted2 = self.db.delete_user(stu_id, './SignBase.db')
             if is_deleted1 and is_deleted2:
-                text = '成功删除学号: <font color=blue>{}</font> '.format(stu_id)
-                informative_text = '<b>请重新训练！</b>'
-                self.call_dialog(QMessageBox.Information, text, informative_text, QMessageBox.Ok)
+                # 在后台从已训练的模型中删除该用户,完成后提示
+                remove_thread = TrainThread(self.face_process, removed=[stu_id])
+                remove_thread.trained_signal.connect(lambda is_removed: self.remove_finished(stu_id, is_removed))
+                self.remove_threads = [thread for thread in self.remove_threads if thread.isRunning()]
+                self.remove_threads.append(remove_thread)
+                remove_thread.start_low_priority()
 
                 # 清空记录值
                 self.stuIDLineEdit.clear()
@@ -138,35 +143,62 @@ class DataManageUI(QWidget):
                 self.deleteUserButton.setEnabled(False)
                 self.trainButton.setIcon(QIcon())
                 # 删除相关人脸数据
-                if os.path.exists('{}/stu_{}'.format('../dataset', stu_id)):
-                    try:
-                        shutil.rmtree('{}/stu_{}'.format('../dataset', stu_id))
-                    except Exception as e:
-                        self.log_queue.put('Error: can not delete {}/stu_{}'.format('../dataset', stu_id))
+                try:
+                    FaceStore(self.log_queue).remove(stu_id)
+                except Exception as e:
+                    self.log_queue.put('Error: can not delete {}/stu_{}'.format('../dataset', stu_id))
             else:
                 self.deleteUserButton.setIcon(QIcon('../icons/error.png'))
 
+    def remove_finished(self, stu_id, is_removed):
+        """
+        从模型中删除用户结束
+        :param stu_id: 用户学号
+        :param is_removed: 是否删除成功
+        :return:
+        """
+        text = '成功删除学号: <font color=blue>{}</font> '.format(stu_id)
+        informative_text = '<b>已从模型中删除！</b>' if is_removed else '<b>请重新训练！</b>'
+        self.call_dialog(QMessageBox.Information, text, informative_text, QMessageBox.Ok)
+
     def train_set(self):
         """
-        训练数据
+        训练数据,在后台线程中进行,训练中再次点击则取消
         :return:
         """
-        text = '开始训练/界面会暂停响应一段时间'
+        if self.train_thread and self.train_thread.isRunning():
+            self.train_thread.cancel()
+            self.trainButton.setEnabled(False)
+            return
+        text = '开始训练/训练在后台进行,可随时取消'
         informative_text = '<b>是否继续？</b>'
         ret = DataManageUI.call_dialog(QMessageBox.Question, text, informative_text,
                                        QMessageBox.Yes | QMessageBox.No,
                                        QMessageBox.No)
         if ret == QMessageBox.Yes:
-            is_trained = self.face_process.train()
-            if is_trained:
-                text = '<font color=green><b>Success!</b></font> 训练完成:../recognizer/trainingData.yml'
-                informative_text = '<b>人脸数据训练完成！</b>'
-                self.call_dialog(QMessageBox.Information, text, informative_text, QMessageBox.Ok)
-                self.trainButton.setIcon(QIcon('../icons/success.png'))
-                # 刷新数据展示
-                self.query_all_set()
-            else:
-                self.trainButton.setIcon(QIcon('../icons/error.png'))
+            self.train_thread = TrainThread(self.face_process, incremental=True)
+            self.train_thread.trained_signal.connect(self.train_finished)
+            self.train_thread.start_low_priority()
+            self.trainButton.setText('取消训练')
+            self.trainButton.setIcon(QIcon())
+
+    def train_finished(self, is_trained):
+        """
+        训练结束
+        :param is_trained: 是否训练成功
+        :return:
+        """
+        self.trainButton.setText('开始训练')
+        self.trainButton.setEnabled(True)
+        if is_trained:
+            text = '<font color=green><b>Success!</b></font> 训练完成:../recognizer/trainingData.yml'
+            informative_text = '<b>人脸数据训练完成！</b>'
+            self.call_dialog(QMessageBox.Information, text, informative_text, QMessageBox.Ok)
+            self.trainButton.setIcon(QIcon('../icons/success.png'))
+            # 刷新数据展示
+            self.query_all_set()
+        else:
+            self.trainButton.setIcon(QIcon('../icons/error.png'))
 
     def receive_log(self):
         """
@@ -229,6 +261,11 @@ class DataManageUI(QWidget):
         ret=self.call_dialog(QMessageBox.Question,text,informative_text,QMessageBox.Yes|QMessageBox.No,
                              QMessageBox.No)
         if ret == QtWidgets.QMessageBox.Yes:
+            if self.train_thread and self.train_thread.isRunning():
+                self.train_thread.cancel()
+                self.train_thread.wait()
+            for thread in self.remove_threads:
+                thread.wait()
             event.accept()
         else:
             event.ignore()
@@ -12,6 +12,7 @@ import multiprocessing
 from datetime import datetime
 from src.database import DataBase
 from src.faceProcess import FaceProcess
+from src.trainThread import TrainThread
 from src.userInfoDiaglog import UserInfoDialog
 
 
@@ -27,6 +28,7 @@ class DataRecordUI(QWidget):
 
         # OpenCV
         self.face_process = None
+        self.train_threads = []  # 后台训练线程,由训练锁依次执行,运行结束前保留引用
 
         # 数据库
         self.db = DataBase(self.log_queue)
@@ -126,6 +128,11 @@ class DataRecordUI(QWidget):
             if not migrate_ok:
                 self.migrateToDbButton.setIcon(QIcon('../icons/error.png'))
             else:
+                # 后台增量训练,只把该用户追加到已有模型,上一次训练未结束时在线程内等待训练锁
+                train_thread = TrainThread(self.face_process, incremental=True)
+                self.train_threads = [thread for thread in self.train_threads if thread.isRunning()]
+                self.train_threads.append(train_thread)
+                train_thread.start_low_priority()
                 text = '<font color=blue>{}</font> 已添加/更新到数据库。'.format(stu_id)
                 informative_text = '<b><font color=blue>{}</font> 的人脸数据采集已完成！</b>'.format(name)
                 self.call_dialog(QMessageBox.Information, text, informative_text, QMessageBox.Ok)
@@ -152,6 +159,8 @@ class DataRecordUI(QWidget):
         打开摄像头
         :return:
         """
+        if self.face_process:
+            self.face_process.stop_camera()
         self.face_process = FaceProcess(self.log_queue)
         self.is_camera_ok = self.face_process.start_camera(self.faceRecordButton, self.timer)
 
@@ -264,7 +273,9 @@ class DataRecordUI(QWidget):
         if ret == QtWidgets.QMessageBox.Yes:
             self.timer.stop()
             if self.face_process:
-                self.face_process.cap.release()
+                self.face_process.stop_camera()
+            for thread in self.train_threads:
+                thread.wait()
             event.accept()
         else:
             event.ignore()
@@ -1,7 +1,9 @@
 import sqlite3
 import os
+import threading
+from contextlib import contextmanager
 from PyQt5.QtWidgets import QTableWidgetItem
-from datetime import datetime
+from datetime import date
 
 
 # 找不到训练过的人脸数据库文件
@@ -29,7 +31,81 @@ class OperationCancel(Exception):
     pass
 
 
+class ConnectionManager(object):
+    """
+    数据库连接管理,每个线程对每个数据库文件保持一个长连接,写操作按数据库文件串行执行
+    """
+    local = threading.local()  # 线程内的连接
+    write_locks = {}  # 数据库文件 -> 写锁
+    lock = threading.Lock()
+    cached_statements = 128  # 每个连接缓存的预编译语句数量
+
+    @classmethod
+    def connect(cls, database):
+        """
+        获取当前线程的长连接,首次连接时开启WAL模式
+        :param database: 数据库文件
+        :return conn: 数据库连接
+        """
+        connections = getattr(cls.local, 'connections', None)
+        if connections is None:
+            connections = cls.local.connections = {}
+        key = os.path.abspath(database)
+        conn = connections.get(key)
+        if conn is None:
+            conn = sqlite3.connect(database, timeout=10, cached_statements=cls.cached_statements)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-8000')
+            connections[key] = conn
+        return conn
+
+    @classmethod
+    def write_lock(cls, database):
+        """
+        :param database: 数据库文件
+        :return lock: 该数据库文件的写锁
+        """
+        key = os.path.abspath(database)
+        with cls.lock:
+            if key not in cls.write_locks:
+                cls.write_locks[key] = threading.RLock()
+            return cls.write_locks[key]
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, database):
+        """
+        写事务,持有写锁,正常结束时提交,出现异常时回滚
+        :param database: 数据库文件
+        :return conn: 数据库连接
+        """
+        with cls.write_lock(database):
+            conn = cls.connect(database)
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    @classmethod
+    def close(cls):
+        """
+        关闭当前线程的所有连接
+        :return:
+        """
+        connections = getattr(cls.local, 'connections', {})
+        for conn in connections.values():
+            conn.close()
+        connections.clear()
+
+
 class DataBase(object):
+    user_db_version = 0  # user_db的数据版本,用户记录变更后递增
+
     def __init__(self, log_queue):
         # 定义的数据库及数据集
         self.user_db = './FaceBase.db'  # 用户数据库
@@ -40,6 +116,14 @@ class DataBase(object):
         # 日志队列,由调用界面传入
         self.log_queue = log_queue
 
+    @classmethod
+    def invalidate_directory(cls):
+        """
+        用户记录已变更,内存中的身份目录需要重建
+        :return:
+        """
+        cls.user_db_version += 1
+
     def check_database(self):
         """
         检查相关的数据库是否存在
@@ -55,7 +139,7 @@ class DataBase(object):
             if not os.path.isfile(self.sign_db):
                 raise DatabaseNotFoundError
 
-            conn = sqlite3.connect(self.user_db)
+            conn = ConnectionManager.connect(self.user_db)
             cursor = conn.cursor()
             cursor.execute('select count(*) from users')
         except DatabaseNotFoundError:
@@ -72,7 +156,6 @@ class DataBase(object):
             is_db_ready = False
         else:
             cursor.close()
-            conn.close()
             self.log_queue.put('Success: found all need database , system will be worked.')
         return is_db_ready
 
@@ -88,7 +171,7 @@ class DataBase(object):
             if not os.path.isfile(database):
                 raise FileNotFoundError
 
-            conn = sqlite3.connect(database)
+            conn = ConnectionManager.connect(database)
             cursor = conn.cursor()
 
             res = cursor.execute('select * from users')
@@ -112,7 +195,6 @@ class DataBase(object):
             query_ok = False
         else:
             cursor.close()
-            conn.close()
             self.log_queue.put('Success: found {}  users in {}'.format(user_count, database))
         return query_ok
 
@@ -123,7 +205,7 @@ class DataBase(object):
         :returns is_user_existed,name,face_id:用户是否存在,姓名,face_id
         """
         name, face_id = None, None
-        conn = sqlite3.connect(self.user_db)
+        conn = ConnectionManager.connect(self.user_db)
         cursor = conn.cursor()
         is_user_existed = True
         try:
@@ -138,7 +220,6 @@ class DataBase(object):
             self.log_queue.put('Error: not found the user {} in database {}'.format(stu_id, self.user_db))
         finally:
             cursor.close()
-            conn.close()
         return is_user_existed, name, face_id
 
     def delete_user(self, stu_id, database):
@@ -148,80 +229,100 @@ class DataBase(object):
         :param database: 数据库,可传入user_db,sign_db
         :return is_deleted:是否删除成功
         """
-        conn = sqlite3.connect(database)
-        cursor = conn.cursor()
-
         is_deleted = True
         try:
-            cursor.execute('delete from users where stu_id=?', (stu_id,))
+            with ConnectionManager.transaction(database) as conn:
+                conn.execute('delete from users where stu_id=?', (stu_id,))
         except Exception as e:
-            cursor.close()
             self.log_queue.put('Error: can not delete user {} from {}, because not found'.format(stu_id, database))
             is_deleted = False
         else:
             self.log_queue.put('Success: delete user {} from {}.'.format(stu_id, database))
-            cursor.close()
-            conn.commit()
-        finally:
-            conn.close()
-            return is_deleted
+            self.invalidate_directory()
+        return is_deleted
 
-    def update_face_id(self, stu_id, face_id):
+    def assign_face_ids(self, stu_ids, reserved=0):
         """
-        更新user_db的训练数据库,标记是否训练
-        :param stu_id: 用户学号
-        :param face_id: 训练后的face_id,默认为-1
-        :return is_update_face_id: face_id是否更新成功
+        批量分配face_id,已有face_id的用户保持不变,只写入发生变化的记录
+        :param stu_ids: 需要训练的用户学号
+        :param reserved: 已分配过的最大face_id,新分配的face_id大于该值,已删除用户的face_id不会复用
+        :return face_ids: {stu_id: face_id},数据库中不存在的用户不包含在内;数据库出错时为None
         """
-        is_update_face_id = True
-        conn = sqlite3.connect(self.user_db)
-        cursor = conn.cursor()
-
+        face_ids = {}
         try:
-            cursor.execute('select * from users where stu_id=?', (stu_id,))
-            ret = cursor.fetchall()
-            if not ret:
-                raise RecordNotFound
-            cursor.execute('update users set face_id=? where stu_id=?', (face_id, stu_id))
-        except RecordNotFound:
-            self.log_queue.put('Error: can not found the record of {} from {}.'.format(stu_id, self.user_db))
-            self.log_queue.put('found {} face data from {}, however ignore.'.format(stu_id, self.dataset))
-            is_update_face_id = False
-        else:
-            self.log_queue.put('Success: update the face_id of {} from {}.'.format(stu_id, self.user_db))
-        finally:
-            cursor.close()
-            conn.commit()
-            conn.close()
-            return is_update_face_id
+            with ConnectionManager.transaction(self.user_db) as conn:
+                existing = dict(conn.execute('select stu_id, face_id from users').fetchall())
+                used = set()
+                # 先保留已有的face_id,重复的重新分配
+                for stu_id in sorted(stu_ids):
+                    face_id = existing.get(stu_id)
+                    if face_id is not None and face_id > 0 and face_id not in used:
+                        face_ids[stu_id] = face_id
+                        used.add(face_id)
+                next_face_id = max([face_id for face_id in existing.values() if face_id] + [reserved, 0]) + 1
+                changes = []
+                for stu_id in sorted(stu_ids):
+                    if stu_id in face_ids or stu_id not in existing:
+                        continue
+                    face_ids[stu_id] = next_face_id
+                    changes.append((next_face_id, stu_id))
+                    next_face_id += 1
+                conn.executemany('update users set face_id=? where stu_id=?', changes)
+        except Exception as e:
+            self.log_queue.put('Error: can not assign face_id in {}.'.format(self.user_db))
+            return None
+        missing = [stu_id for stu_id in stu_ids if stu_id not in existing]
+        if missing:
+            self.log_queue.put('Error: can not found the record of {} from {}.'.format(', '.join(missing), self.user_db))
+            self.log_queue.put('found {} face data from {}, however ignore.'.format(len(missing), self.dataset))
+        if changes:
+            self.invalidate_directory()
+        self.log_queue.put('Success: assign face_id to {} users, {} changed in {}.'.format(len(face_ids), len(changes),
+                                                                                          self.user_db))
+        return face_ids
+
+    def update_sign_times(self, records):
+        """
+        批量更新签到时间,在同一事务中提交
+        :param records: [(stu_id, 签到时间)]
+        :return updated: 成功更新的学号
+        """
+        updated = []
+        try:
+            with ConnectionManager.transaction(self.sign_db) as conn:
+                for stu_id, signed_time in records:
+                    cursor = conn.execute('update users set signed=?,signed_time=? where stu_id=?',
+                                          ('是', signed_time, stu_id))
+                    if cursor.rowcount == 0:
+                        self.log_queue.put('Error: can not found the record of {} from {}.'.format(stu_id,
+                                                                                                  self.sign_db))
+                    else:
+                        updated.append(stu_id)
+        except Exception as e:
+            updated = []
+            self.log_queue.put('Error: can not update the signed_time in {}.'.format(self.sign_db))
+        return updated
 
-    def update_sign_time(self, stu_id):
+    def query_signed(self, day=None):
         """
-        根据stu_id更新签到时间
-        :param stu_id: 用户学号
-        :return is_update_sign_time:是否成功更新签到时间
+        查询当天已签到的用户,signed列不会按天重置,以签到时间为准
+        :param day: 签到日期,默认为今天
+        :return signed: 已签到的学号集合
         """
-        is_update_sign_time = True
-        conn = sqlite3.connect(self.sign_db)
+        signed = set()
+        if not os.path.isfile(self.sign_db):
+            return signed
+        conn = ConnectionManager.connect(self.sign_db)
         cursor = conn.cursor()
-
         try:
-            cursor.execute('select * from users where stu_id=?', (stu_id,))
-            ret = cursor.fetchall()
-            if not ret:
-                raise RecordNotFound
-            cursor.execute('update users set signed=?,signed_time=? where stu_id=?',
-                           ('是', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), stu_id))
-        except RecordNotFound:
-            self.log_queue.put('Error: can not found the record of {} from {}.'.format(stu_id, self.sign_db))
-            is_update_sign_time = False
-        else:
-            self.log_queue.put('Success: update the signed_time {} from {}.'.format(stu_id, self.sign_db))
+            cursor.execute('select stu_id from users where signed=? and substr(signed_time, 1, 10)=?',
+                           ('是', str(day or date.today())))
+            signed = {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            self.log_queue.put('Error: can not query signed users from {}.'.format(self.sign_db))
         finally:
             cursor.close()
-            conn.commit()
-            conn.close()
-            return is_update_sign_time
+        return signed
 
     def create_database(self):
         """
@@ -233,61 +334,58 @@ class DataBase(object):
             os.makedirs(self.dataset)
         if not os.path.exists('../recognizer'):
             os.makedirs('../recognizer')
-        conn1 = sqlite3.connect(self.user_db)
-        cursor1 = conn1.cursor()
-        try:
-            # 查询数据表,不存在则创建
-            cursor1.execute('''CREATE TABLE IF NOT EXISTS users (
-                                          stu_id VARCHAR(8) PRIMARY KEY NOT NULL,
-                                          face_id INTEGER DEFAULT -1,
-                                          name VARCHAR(50) NOT NULL,
-                                          created_time DATE DEFAULT (date('now','localtime')),
-                                          _class VARCHAR(50) NOT NULL,
-                                          email VARCHAR(50) NOT NULL,
-                                          phone VARCHAR(50) NOT NULL,
-                                          addr VARCHAR(50) NOT NULL
-                                          )
-                                      ''')
-            # 查询表记录数
-            cursor1.execute('SELECT Count(*) FROM users')
-            result = cursor1.fetchone()
-            user_num = result[0]
-        except Exception as e:
-            self.log_queue.put('Error: can not create database: {}.'.format(self.user_db))
-            is_created = False
-        else:
-            self.log_queue.put(
-                'Success: create database {} successfully, found {} users'.format(self.user_db, user_num))
-        finally:
-            cursor1.close()
-            conn1.commit()
-            conn1.close()
-
-        conn2 = sqlite3.connect(self.sign_db)
-        cursor2 = conn2.cursor()
-        try:
-            cursor2.execute('''CREATE TABLE IF NOT EXISTS users (
-                                                     stu_id VARCHAR(8) PRIMARY KEY NOT NULL,
-                                                     name VARCHAR(30) NOT NULL,
-                                                     _class  VARCHAR(30) NOT NULL,
-                                                     signed VARCHAR(30)   DEFAULT  '否',
-                                                     signed_time VARCHAR(50) DEFAULT  '无'
-                                                     )
-                                                 ''')
-            # 查询表记录数
-            cursor2.execute('SELECT Count(*) FROM users')
-            result = cursor2.fetchone()
-            user_count = result[0]
-        except Exception as e:
-            self.log_queue.put('Error: can not create database: {}.'.format(self.sign_db))
-            is_created = False
-        else:
-            self.log_queue.put(
-                'Success: create database {} successfully, found {} users'.format(self.sign_db, user_count))
-        finally:
-            cursor2.close()
-            conn2.commit()
-            conn2.close()
+        with ConnectionManager.transaction(self.user_db) as conn1:
+            cursor1 = conn1.cursor()
+            try:
+                # 查询数据表,不存在则创建
+                cursor1.execute('''CREATE TABLE IF NOT EXISTS users (
+                                              stu_id VARCHAR(8) PRIMARY KEY NOT NULL,
+                                              face_id INTEGER DEFAULT -1,
+                                              name VARCHAR(50) NOT NULL,
+                                              created_time DATE DEFAULT (date('now','localtime')),
+                                              _class VARCHAR(50) NOT NULL,
+                                              email VARCHAR(50) NOT NULL,
+                                              phone VARCHAR(50) NOT NULL,
+                                              addr VARCHAR(50) NOT NULL
+                                              )
+                                          ''')
+                cursor1.execute('CREATE INDEX IF NOT EXISTS users_face_id ON users (face_id)')
+                # 查询表记录数
+                cursor1.execute('SELECT Count(*) FROM users')
+                result = cursor1.fetchone()
+                user_num = result[0]
+            except Exception as e:
+                self.log_queue.put('Error: can not create database: {}.'.format(self.user_db))
+                is_created = False
+            else:
+                self.log_queue.put(
+                    'Success: create database {} successfully, found {} users'.format(self.user_db, user_num))
+            finally:
+                cursor1.close()
+
+        with ConnectionManager.transaction(self.sign_db) as conn2:
+            cursor2 = conn2.cursor()
+            try:
+                cursor2.execute('''CREATE TABLE IF NOT EXISTS users (
+                                                         stu_id VARCHAR(8) PRIMARY KEY NOT NULL,
+                                                         name VARCHAR(30) NOT NULL,
+                                                         _class  VARCHAR(30) NOT NULL,
+                                                         signed VARCHAR(30)   DEFAULT  '否',
+                                                         signed_time VARCHAR(50) DEFAULT  '无'
+                                                         )
+                                                     ''')
+                # 查询表记录数
+                cursor2.execute('SELECT Count(*) FROM users')
+                result = cursor2.fetchone()
+                user_count = result[0]
+            except Exception as e:
+                self.log_queue.put('Error: can not create database: {}.'.format(self.sign_db))
+                is_created = False
+            else:
+                self.log_queue.put(
+                    'Success: create database {} successfully, found {} users'.format(self.sign_db, user_count))
+            finally:
+                cursor2.close()
         return is_created
 
     def migrate(self, stu_id, name,class_,email,phone,addr):
@@ -297,86 +395,145 @@ class DataBase(object):
         :param name: 姓名
         :return is_in_database,migrate_ok: 是否在数据库,是否同步成功
         """
-        conn1 = sqlite3.connect(self.user_db)
-        cursor1 = conn1.cursor()
         is_in_database = False
         migrate_ok = True
-        try:
-            cursor1.execute('select * from users where stu_id=?', (stu_id,))
-            if cursor1.fetchall():
-                is_in_database = True
-                # 更新数据库信息
-                cursor1.execute('update users set name=?,_class=?,email=?,phone=?,addr=? where stu_id=?', (
-                    name,class_,email,phone,addr, stu_id))
+        with ConnectionManager.transaction(self.user_db) as conn1:
+            cursor1 = conn1.cursor()
+            try:
+                cursor1.execute('select * from users where stu_id=?', (stu_id,))
+                if cursor1.fetchall():
+                    is_in_database = True
+                    # 更新数据库信息
+                    cursor1.execute('update users set name=?,_class=?,email=?,phone=?,addr=? where stu_id=?', (
+                        name,class_,email,phone,addr, stu_id))
+                else:
+                    cursor1.execute('insert into users (stu_id,name,_class,email,phone,addr) values (?,?,?,?,?,?)', (
+                        stu_id, name,class_,email,phone,addr))
+                cursor1.execute('select count(*) from users')
+                result = cursor1.fetchone()
+                user_num = result[0]
+            except Exception as e:
+                self.log_queue.put('Error: can not insert or update to database {}.'.format(self.user_db))
+                migrate_ok = False
             else:
-                cursor1.execute('insert into users (stu_id,name,_class,email,phone,addr) values (?,?,?,?,?,?)', (
-                    stu_id, name,class_,email,phone,addr))
-            cursor1.execute('select count(*) from users')
-            result = cursor1.fetchone()
-            user_num = result[0]
+                self.log_queue.put('Success: update or insert successfully, found {} users in {}'.format(user_num,
+                                                                                                         self.user_db))
+            finally:
+                cursor1.close()
+        self.invalidate_directory()
+
+        # sign_db
+        with ConnectionManager.transaction(self.sign_db) as conn2:
+            cursor2 = conn2.cursor()
+            try:
+                cursor2.execute('select * from users where stu_id=?', (stu_id,))
+                if cursor2.fetchall():
+                    is_in_database = True
+                    # 更新数据库信息
+                    cursor2.execute('update users set name=?,_class=? where stu_id=?', (name,class_, stu_id))
+                else:
+                    cursor2.execute('insert into users (stu_id,name,_class) values (?,?,?)', (stu_id, name,class_))
+                cursor2.execute('select count(*) from users')
+                result = cursor2.fetchone()
+                user_count = result[0]
+            except Exception as e:
+                self.log_queue.put('Error: can not insert or update to database {}.'.format(self.sign_db))
+                migrate_ok = False
+            else:
+                self.log_queue.put('Success: update or insert successfully, found {} users in {}'.format(user_count,
+                                                                                                         self.sign_db))
+            finally:
+                cursor2.close()
+        return is_in_database, migrate_ok
+
+    def load_face_directory(self):
+        """
+        一次性读取所有已训练用户,用于识别时查询
+        :return directory: {face_id: (stu_id, name, created_time)}
+        """
+        directory = {}
+        conn = ConnectionManager.connect(self.user_db)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT face_id, stu_id, name, created_time FROM users WHERE face_id != -1')
+            for face_id, stu_id, name, created_time in cursor.fetchall():
+                directory[face_id] = (stu_id, name, created_time)
         except Exception as e:
-            self.log_queue.put('Error: can not insert or update to database {}.'.format(self.user_db))
-            migrate_ok = False
-        else:
-            self.log_queue.put('Success: update or insert successfully, found {} users in {}'.format(user_num,
-                                                                                                     self.user_db))
+            self.log_queue.put('Error: can not load face directory from {}.'.format(self.user_db))
         finally:
-            cursor1.close()
-            conn1.commit()
-            conn1.close()
+            cursor.close()
+        return directory
 
-        # sign_db
-        conn2 = sqlite3.connect(self.sign_db)
-        cursor2 = conn2.cursor()
+    def query_classes(self):
+        """
+        查询所有班级
+        :return classes: 班级列表
+        """
+        classes = []
+        if not os.path.isfile(self.user_db):
+            return classes
+        conn = ConnectionManager.connect(self.user_db)
+        cursor = conn.cursor()
         try:
-            cursor2.execute('select * from users where stu_id=?', (stu_id,))
-            if cursor2.fetchall():
-                is_in_database = True
-                # 更新数据库信息
-                cursor2.execute('update users set name=?,_class=? where stu_id=?', (name,class_, stu_id))
-            else:
-                cursor2.execute('insert into users (stu_id,name,_class) values (?,?,?)', (stu_id, name,class_))
-            cursor2.execute('select count(*) from users')
-            result = cursor2.fetchone()
-            user_count = result[0]
+            cursor.execute('SELECT DISTINCT _class FROM users ORDER BY _class')
+            classes = [row[0] for row in cursor.fetchall()]
         except Exception as e:
-            self.log_queue.put('Error: can not insert or update to database {}.'.format(self.sign_db))
-            migrate_ok = False
-        else:
-            self.log_queue.put('Success: update or insert successfully, found {} users in {}'.format(user_count,
-                                                                                                     self.sign_db))
+            self.log_queue.put('Error: can not query classes from {}.'.format(self.user_db))
         finally:
-            cursor2.close()
-            conn2.commit()
-            conn2.close()
-        return is_in_database, migrate_ok
+            cursor.close()
+        return classes
 
-    def query_by_face_id(self, face_id):
+    def load_face_classes(self):
         """
-        根据face_id查询数据
-        :param face_id: 用户face_id
-        :return:
+        一次性读取所有已训练用户的班级,用于按班级拆分模型
+        :return classes: {face_id: _class}
         """
-        is_known = True
-        stu_id, name, created_time = '', '', ''
-        conn = sqlite3.connect(self.user_db)
+        classes = {}
+        conn = ConnectionManager.connect(self.user_db)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT * FROM users WHERE face_id=?", (face_id,))
-            result = cursor.fetchall()
-            if result:
-                stu_id = result[0][0]
-                name = result[0][2]
-                created_time = result[0][3]
-            else:
-                is_known = False
-                raise Exception
+            cursor.execute('SELECT face_id, _class FROM users WHERE face_id != -1')
+            classes = dict(cursor.fetchall())
         except Exception as e:
-            self.log_queue.put('Error: can not found user by face_id {}'.format(face_id))
+            self.log_queue.put('Error: can not load classes of users from {}.'.format(self.user_db))
         finally:
             cursor.close()
-            conn.close()
-            return is_known, stu_id, name, created_time
+        return classes
+
+
+class IdentityDirectory(object):
+    """
+    内存中的身份目录,face_id -> (stu_id, name, created_time),用户记录变更后在下次查询时重建
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.entries = {}
+        self.version = None  # 构建时的user_db数据版本
+
+    def rebuild(self):
+        """
+        从user_db重新加载
+        :return:
+        """
+        self.version = DataBase.user_db_version
+        self.entries = self.db.load_face_directory()
+        self.db.log_queue.put('Success: load {} identities from {}.'.format(len(self.entries), self.db.user_db))
+
+    def query_by_face_id(self, face_id):
+        """
+        根据face_id查询,目录有效时不访问数据库
+        :param face_id: 用户face_id
+        :returns is_known,stu_id,name,created_time: 是否已知用户,学号,姓名,创建时间
+        """
+        if self.version != DataBase.user_db_version:
+            self.rebuild()
+        entry = self.entries.get(face_id)
+        if entry is None:
+            self.db.log_queue.put('Error: can not found user by face_id {}'.format(face_id))
+            return False, '', '', ''
+        stu_id, name, created_time = entry
+        return True, stu_id, name, created_time
 
 
 if __name__ == '__main__':
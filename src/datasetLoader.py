@@ -0,0 +1,101 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from src.faceStore import FaceStore
+
+
+# 训练被取消
+class TrainCancelled(Exception):
+    pass
+
+
+class DatasetLoader(object):
+    """
+    人脸数据加载,多线程解码图片,按批次输出,内存占用与数据集大小无关
+    """
+
+    def __init__(self, log_queue, workers=None, chunk_size=1000, cancel_event=None):
+        self.log_queue = log_queue
+        self.cancel_event = cancel_event  # 取消事件,设置后在下一批次前停止
+        self.workers = workers or os.cpu_count() or 1  # 解码线程数
+        self.chunk_size = chunk_size  # 每批图片数量
+        self.peak_bytes = 0  # 同时存在的已解码图片占用的最大内存
+
+    @staticmethod
+    def list_images(data_folder_path, face_ids):
+        """
+        列出需要加载的图片,紧凑格式的用户以内存映射方式读取,旧的图片目录逐张解码
+        :param data_folder_path: 文件目录
+        :param face_ids: {stu_id: face_id},不在其中的用户跳过
+        :return items: [(图片路径或图像, face_id)]
+        """
+        store = FaceStore(None, data_folder_path)
+        index = store.load_index()
+        items = []
+        for stu_id in store.list_subjects():
+            if stu_id not in face_ids:
+                continue
+            if store.is_packed(stu_id, index):
+                faces = store.load(stu_id)
+                items.extend((faces[i], face_ids[stu_id]) for i in range(len(faces)))
+                continue
+            subject_dir_path = store.folder_path(stu_id)
+            for image_name in os.listdir(subject_dir_path):
+                if image_name.startswith('.'):
+                    continue
+                items.append((os.path.join(subject_dir_path, image_name), face_ids[stu_id]))
+        return items
+
+    @staticmethod
+    def read_image(source):
+        """
+        读取灰度图,解码时释放GIL,可多线程并行
+        :param source: 图片路径,或已在内存映射中的图像
+        :return image: 灰度图,无法读取时为None
+        """
+        if isinstance(source, np.ndarray):
+            return source
+        return cv2.imread(source, cv2.IMREAD_GRAYSCALE)
+
+    def iter_chunks(self, items):
+        """
+        按批次加载图片,处理当前批次时后台解码下一批次
+        :param items: list_images的结果
+        :return: 生成器,每次输出(faces, labels),取消时抛出TrainCancelled
+        """
+        total = len(items)
+        total_subjects = len(set(face_id for _, face_id in items))
+        subjects = set()
+        loaded = 0
+        start = time.time()
+        chunks = [items[i:i + self.chunk_size] for i in range(0, total, self.chunk_size)]
+        self.peak_bytes = 0
+        last_bytes = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            images = executor.map(self.read_image, [path for path, _ in chunks[0]]) if chunks else None
+            for index, chunk in enumerate(chunks):
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise TrainCancelled
+                faces = list(images)
+                if index + 1 < len(chunks):
+                    images = executor.map(self.read_image, [path for path, _ in chunks[index + 1]])
+                labels = [face_id for (path, face_id), face in zip(chunk, faces) if face is not None]
+                for (path, face_id), face in zip(chunk, faces):
+                    if face is None:
+                        self.log_queue.put('Error: can not read image {}.'.format(path))
+                faces = [face for face in faces if face is not None]
+                chunk_bytes = sum(face.nbytes for face in faces)
+                self.peak_bytes = max(self.peak_bytes, chunk_bytes + last_bytes)
+                last_bytes = chunk_bytes
+                loaded += len(chunk)
+                subjects.update(labels)
+                rate = loaded / max(time.time() - start, 1e-6)
+                self.log_queue.put('load {}/{} images, {}/{} subjects, {:.0f} images/s, ETA {:.0f} s.'.format(
+                    loaded, total, len(subjects), total_subjects, rate, (total - loaded) / rate))
+                if faces:
+                    yield faces, np.array(labels)
+        self.log_queue.put('Success: load {} images with {} threads in {:.1f} s, peak image memory {:.1f} MB.'.format(
+            total, self.workers, time.time() - start, self.peak_bytes / 1024 / 1024))
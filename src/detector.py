@@ -0,0 +1,112 @@
+import os
+
+import cv2
+import numpy as np
+
+
+class FaceDetector(object):
+    """
+    人脸检测接口,各后端的默认参数为类属性,可在创建时覆盖
+    """
+    is_color = False  # 是否在BGR图像中检测,否则在均衡化后的灰度图中检测
+
+    def __init__(self, **params):
+        for name, value in params.items():
+            if not hasattr(self, name):
+                raise ValueError('unknown parameter {} of {}'.format(name, type(self).__name__))
+            setattr(self, name, value)
+
+    def detect(self, image, min_size):
+        """
+        :param image: is_color为False时为均衡化后的灰度图,否则为BGR图像
+        :param min_size: 最小人脸边长
+        :return faces: 人脸位置列表 [(x, y, w, h)]
+        """
+        raise NotImplementedError
+
+
+class CascadeDetector(FaceDetector):
+    """
+    级联分类器
+    """
+    path = None  # 级联分类器文件
+    scale_factor = 1.3  # 相邻两次检测的图像缩放比例
+    min_neighbors = 5  # 至少有多少个相邻检测结果才保留
+
+    def __init__(self, **params):
+        super(CascadeDetector, self).__init__(**params)
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(self.path)
+        self.cascade = cv2.CascadeClassifier(self.path)
+        if self.cascade.empty():
+            raise ValueError('can not load cascade classifier {}'.format(self.path))
+
+    def detect(self, image, min_size):
+        faces = self.cascade.detectMultiScale(image, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+                                              minSize=(min_size, min_size))
+        return [tuple(face) for face in faces]
+
+
+class HaarDetector(CascadeDetector):
+    """
+    Haar特征级联分类器
+    """
+    path = '../haarcascades/haarcascade_frontalface_default.xml'
+    scale_factor = 1.3
+    min_neighbors = 5
+
+
+class LBPDetector(CascadeDetector):
+    """
+    LBP特征级联分类器,只做整数比较,比Haar快,误检稍多
+    """
+    path = '../lbpcascades/lbpcascade_frontalface_improved.xml'
+    scale_factor = 1.1
+    min_neighbors = 4
+
+
+class DnnDetector(FaceDetector):
+    """
+    cv2.dnn的SSD人脸检测模型(res10_300x300),只使用CPU,模型在彩色图像上训练,输入BGR图像
+    """
+    is_color = True
+    model = '../models/res10_300x300_ssd_iter_140000.caffemodel'  # 模型权重
+    config = '../models/deploy.prototxt'  # 网络结构
+    input_size = 300  # 网络输入边长
+    mean = (104.0, 177.0, 123.0)  # 训练时减去的BGR均值
+    confidence = 0.6  # 置信度阈值
+
+    def __init__(self, **params):
+        super(DnnDetector, self).__init__(**params)
+        for path in (self.model, self.config):
+            if not os.path.isfile(path):
+                raise FileNotFoundError(path)
+        self.net = cv2.dnn.readNet(self.model, self.config)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def detect(self, image, min_size):
+        rows, cols = image.shape[:2]
+        self.net.setInput(cv2.dnn.blobFromImage(image, 1.0, (self.input_size, self.input_size), self.mean))
+        detections = self.net.forward().reshape(-1, 7)  # [_, 类别, 置信度, x1, y1, x2, y2],坐标为比例
+        detections = detections[detections[:, 2] >= self.confidence]
+        boxes = np.clip(detections[:, 3:7], 0, 1) * np.array([cols, rows, cols, rows])
+        faces = []
+        for x1, y1, x2, y2 in boxes.astype(int):
+            if x2 - x1 >= min_size and y2 - y1 >= min_size:
+                faces.append((x1, y1, x2 - x1, y2 - y1))
+        return faces
+
+
+detectors = {'haar': HaarDetector, 'lbp': LBPDetector, 'dnn': DnnDetector}  # 后端名称 -> 检测器
+
+
+def create_detector(backend, **params):
+    """
+    :param backend: 后端名称,haar, lbp, dnn
+    :param params: 覆盖后端的默认参数
+    :return detector: FaceDetector
+    """
+    if backend not in detectors:
+        raise ValueError('unknown detector backend {}, available: {}'.format(backend, ', '.join(detectors)))
+    return detectors[backend](**params)
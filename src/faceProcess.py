@@ -1,9 +1,24 @@
 import cv2
 import os
+import threading
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from datetime import date
 from PyQt5.QtGui import QImage, QPixmap
-from src.database import DataBase
+from src.database import DataBase, IdentityDirectory, RecordNotFound
+from src.capture import FrameBuffer, CaptureThread, FrameWorker, open_camera
+from src.workerPool import DetectionPool, WorkerDied
+from src.tracker import FaceTracker, DetectionScheduler, DetectionRegion, IdentityCache
+from src.overlay import OverlayRenderer
+from src.signWriter import SignWriter
+from src.datasetLoader import DatasetLoader, TrainCancelled
+from src.model import TrainManifest, LBPHModel
+from src.faceStore import FaceStore
+from src.lbph import LBPHRecognizer
+from src.modelFile import ModelFile
+from src.modelWatcher import ModelWatcher
+from src.motionGate import MotionGate
+from src.detector import create_detector
+from src.allocationTracer import AllocationTracer
 
 
 # 检测过程有干扰
@@ -16,21 +31,75 @@ class FaceProcess(object):
     face_record_num = 0  # 记录当前采集数目
     cap = cv2.VideoCapture()  # 摄像头
     recognizer = None  # 识别器
-    face_cascade = None
-    signed = []  # 记录签到的人脸
+    recognizer_engine = 'numpy'  # 识别引擎,'numpy'为矩阵批量计算的LBPHRecognizer,'opencv'为LBPHFaceRecognizer
+    detector_backend = 'haar'  # 人脸检测后端: haar, lbp, dnn
+    detector_params = {}  # 覆盖检测后端的默认参数,如{'min_neighbors': 3}
+    detect_scale = 0.5  # 检测时灰度图的缩放比例,人脸框映射回原图,1为原图检测
+    min_face_size = 90  # 原图中可检测的最小人脸边长
+    detect_roi = None  # 固定检测区域(x, y, w, h),相对画面宽高的比例,None为全画面
+    roi_margin = 1.0  # 在上次人脸框外扩该比例的区域内检测
+    roi_growth = 1.5  # 未检测到人脸时外扩比例的增长倍数
+    full_scan_interval = 10  # 每隔多少次检测扫描一次整个固定区域,1为每次都扫描
+    overlay = OverlayRenderer('fzqgjt.ttf')  # 文字标注,缓存字体及文字
+    train_lock = threading.Lock()  # 训练锁
+    frame_buffer_size = 2  # 帧缓冲区大小
+    paint_interval = 15  # 界面刷新间隔,单位ms
+    pipeline_workers = 0  # 检测识别进程数,0为在处理线程内完成
+    detect_interval = 5  # 每隔几帧运行一次人脸检测,其余帧跟踪,1为每帧检测
+    min_track_score = 0.6  # 跟踪置信度阈值,低于该值立即重新检测
+    identity_ttl = 2.0  # 身份缓存有效期,单位秒
+    identity_min_iou = 0.5  # 人脸框漂移超过该交并比时重新识别
+    identity_log_interval = 1000  # 每查询多少次身份缓存记录一次命中情况
+    motion_idle_after = 3.0  # 画面静止多久后进入空闲状态,单位秒,0为一直检测
+    motion_idle_interval = 0.2  # 空闲状态的处理间隔,单位秒
+    trace_allocations = False  # 用tracemalloc统计每帧的内存分配,会降低处理速度
+    prototypes_per_subject = 10  # 训练后每个用户保留的代表直方图数量,0为保留全部
+    condense_eval_samples = 200  # 评估精简前后准确率的样本数量,0为不评估
+    model_watch_interval = 1.0  # 检查模型是否发布新版本的间隔,单位秒,0为不检查
+    multi_face_sign = True  # 签到时识别画面中的全部人脸,False时与采集一样只允许一张人脸
+    shard_by_class = False  # 发布模型时另按班级拆分为分片,选择班级后只在其分片中识别
 
     def __init__(self, log_queue):
         super(FaceProcess, self).__init__()
         self.log_queue = log_queue
         self.db = DataBase(log_queue)
+        self.directory = IdentityDirectory(self.db)  # 内存中的身份目录
+        self.sign_date = date.today()  # 签到日期,跨天后重新签到
+        self.signed = self.db.query_signed(self.sign_date)  # 记录当天签到的人脸,由sign_db初始化
+        self.sign_writer = None  # 签到写入线程
+        self.record_writer = None  # 人脸数据写入
         self.confidenceThreshold = 50  # 置信度阈值,越小精度越高
         self.is_train_data_loaded = False  # 训练数据加载
-        self.is_face_detect_load = False  # 识别数据加载
+        self.detector = None  # 人脸检测器,首次检测时创建
+        self.buffers = {}  # 预分配的预处理缓冲区,每帧复用
+        self.tracer = AllocationTracer(self.trace_allocations)  # 内存分配统计
+        # 采集线程及处理线程
+        self.frame_buffer = FrameBuffer(self.frame_buffer_size)
+        self.capture_thread = None
+        self.frame_worker = None
+        self.painted_seq = 0  # 已绘制的帧序号
+        self.pool = None  # 检测识别进程池
+        self.pool_faces = []  # 进程池最近返回的人脸框,主进程的跟踪器在进程池模式下为空
+        # 检测调度及跟踪
+        self.tracker = FaceTracker()
+        self.scheduler = DetectionScheduler(self.detect_interval, self.min_track_score)
+        self.region = DetectionRegion(self.detect_roi, self.roi_margin, self.roi_growth, self.full_scan_interval)
+        self.face_source = None  # 当前帧人脸框来源: detect 检测, track 跟踪
+        self.identity_cache = IdentityCache(self.identity_ttl, self.identity_min_iou)
+        # 画面静止时空闲
+        self.motion_gate = None
+        if self.motion_idle_after:
+            self.motion_gate = MotionGate(self.motion_idle_after, self.motion_idle_interval)
+        # 模型热更新
+        self.model_version = None  # 当前使用的模型版本
+        self.model_watcher = None  # 模型监视线程
+        self.cached_recognizer = None  # 身份缓存对应的识别器
+        self.active_classes = None  # 参与识别的班级,None为全部
 
     @staticmethod
     def change_cv2_draw(image, str, local, sizes, colour):
         """
-        给图片添加文字
+        给图片添加文字,多个文字应通过overlay.draw一次绘制
         :param image: 输入的图像,已读取
         :param str: 添加的字符
         :param local: 位置
@@ -38,13 +107,33 @@ class FaceProcess(object):
         :param colour: 颜色RGB
         :return image:添加文字的图像
         """
-        cv2img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(cv2img)
-        draw = ImageDraw.Draw(pil_img)  # 图片上打印
-        font = ImageFont.truetype('fzqgjt.ttf', sizes, encoding="utf-8")  # 加载字体
-        draw.text(local, str, colour, font=font)
-        image = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-        return image
+        return FaceProcess.overlay.draw(image, [(str, local, sizes, colour)])
+
+    def buffer(self, name, shape):
+        """
+        预分配的uint8缓冲区,按名称复用,第一维不足或其余维度变化时重新分配
+        :param name: 缓冲区名称
+        :param shape: 需要的尺寸
+        :return buffer: 缓冲区的前shape[0]行
+        """
+        array = self.buffers.get(name)
+        if array is None or len(array) < shape[0] or array.shape[1:] != tuple(shape[1:]):
+            array = self.buffers[name] = np.empty(shape, np.uint8)
+        return array[:shape[0]]
+
+    def preprocess(self, img):
+        """
+        转换为灰度图并直方图均衡化,结果写入预分配的缓冲区,下一帧会被覆盖
+        :param img: 输入的图像帧
+        :return gray: 均衡化后的灰度图
+        """
+        gray = self.buffer('gray', img.shape[:2])
+        with self.tracer.stage('gray'):
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        # 直方图均衡化
+        with self.tracer.stage('equalize'):
+            cv2.equalizeHist(gray, dst=gray)
+        return gray
 
     def detect_face(self, img):
         """
@@ -52,13 +141,48 @@ class FaceProcess(object):
         :param img:输入的图像帧
         :return :返回人脸位置,及脸部图像
         """
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        # 直方图均衡化
-        gray = cv2.equalizeHist(gray)
-        if not self.is_face_detect_load:
-            self.face_cascade = cv2.CascadeClassifier('../haarcascades/haarcascade_frontalface_default.xml')
-            self.is_face_detect_load = True
-        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.3, minNeighbors=5, minSize=(90, 90))
+        return self.detect_gray(self.preprocess(img), img)
+
+    def detect_faces(self, gray, img):
+        """
+        检测全部人脸,只检测region确定的区域。级联分类器使用均衡化后的灰度图,DNN使用原图
+        :param gray: 均衡化后的灰度图
+        :param img: 原图,BGR
+        :return faces: 人脸位置列表
+        """
+        if self.detector is None:
+            self.detector = create_detector(self.detector_backend, **self.detector_params)
+        image = img if self.detector.is_color else gray
+        scale = self.detect_scale
+        min_size = max(int(round(self.min_face_size * scale)), 1)
+        rows, cols = gray.shape[:2]
+        small_buffer = self.buffer('small_bgr' if self.detector.is_color else 'small',
+                                   (int(round(rows * scale)), int(round(cols * scale))) + image.shape[2:])
+        boxes = []
+        for (region_x, region_y, region_w, region_h) in self.region.next(gray.shape):
+            if min(region_w, region_h) < self.min_face_size:
+                continue
+            small = image[region_y:region_y + region_h, region_x:region_x + region_w]
+            if scale != 1:
+                # 在缩小的图像中检测,人脸框映射回原图,识别仍使用原尺寸的人脸
+                size = (int(round(region_w * scale)), int(round(region_h * scale)))
+                with self.tracer.stage('downscale'):
+                    small = cv2.resize(small, size, dst=small_buffer[:size[1], :size[0]], interpolation=cv2.INTER_AREA)
+            for (x, y, w, h) in self.detector.detect(small, min_size):
+                x, y = int(round(x / scale)), int(round(y / scale))
+                w, h = min(int(round(w / scale)), region_w - x), min(int(round(h / scale)), region_h - y)
+                boxes.append((region_x + x, region_y + y, w, h))
+        self.region.update(boxes)
+        return boxes
+
+    def detect_gray(self, gray, img):
+        """
+        检测人脸,只允许一张人脸,用于采集
+        :param gray: 均衡化后的灰度图
+        :param img: 原图,BGR
+        :return :返回人脸位置,及灰度图中的脸部图像
+        """
+        faces = self.detect_faces(gray, img)
         if len(faces) == 0:
             return None, None
         try:
@@ -70,99 +194,509 @@ class FaceProcess(object):
         (x, y, w, h) = faces[0]
         return (x, y, w, h), gray[y:y + h, x:x + w]
 
-    def face_detect_update(self):
+    def locate_faces(self, img):
         """
-        检测人脸,识别信息,更新输出
-        :return frame: 处理过得画面帧,是否识别
+        检测或跟踪人脸,由检测调度决定当前帧是否运行检测,跟踪目标与返回的人脸一一对应
+        :param img: 输入的图像帧
+        :returns faces,gray: 人脸位置列表,均衡化后的灰度图
+        """
+        gray = self.preprocess(img)
+        if not self.scheduler.need_detect(self.tracker):
+            tracks = self.tracker.update(gray)
+            if not self.scheduler.is_lost(tracks):
+                self.scheduler.record('track')
+                self.face_source = 'track'
+                return [track.box for track in tracks], gray
+        if self.multi_face_sign:
+            faces = self.detect_faces(gray, img)
+        else:
+            face, _ = self.detect_gray(gray, img)
+            faces = [face] if face else []
+        self.scheduler.record('detect')
+        self.face_source = 'detect'
+        self.tracker.assign(gray, faces)
+        return faces, gray
+
+    def start_capture(self):
+        """
+        打开摄像头并启动采集线程
+        :return:
+        """
+        open_camera(self.cap)
+        if self.capture_thread is None or not self.capture_thread.is_alive():
+            self.frame_buffer.clear()
+            self.capture_thread = CaptureThread(self.cap, self.frame_buffer)
+            self.capture_thread.start()
+
+    def read_frame(self, timeout=0.1):
+        """
+        读取最新帧,不会读到旧帧
+        :param timeout: 等待新帧的时间,0为不等待
+        :return frame: 图像帧,无新帧时为None
+        """
+        self.start_capture()
+        seq, frame = self.frame_buffer.get_latest(timeout)
+        return frame
+
+    def load_train_data(self):
+        """
+        加载训练数据
+        :return:
         """
-        if not self.cap.isOpened():
-            self.cap.open(cv2.CAP_DSHOW + 0)
-        ret, frame = self.cap.read()
-        face, gray = self.detect_face(frame)
-        # 加载数据
         if not self.is_train_data_loaded and os.path.isfile('../recognizer/trainingData.yml'):
-            self.recognizer = cv2.face.LBPHFaceRecognizer_create()
-            self.recognizer.read('../recognizer/trainingData.yml')
+            recognizer, version = self.create_recognizer()
+            self.swap_recognizer(recognizer, version)
             self.is_train_data_loaded = True
-        if face:
-            gray = cv2.resize(gray, (200, 200))
+            self.directory.rebuild()
+
+    def create_recognizer(self):
+        """
+        读取当前发布的模型,可在后台线程中调用
+        :returns recognizer,version: 识别器,没有模型时为None;模型版本
+        """
+        manifest = TrainManifest()
+        manifest.load()
+        if not os.path.isfile('../recognizer/trainingData.yml'):
+            return None, manifest.version
+        if self.recognizer_engine == 'numpy':
+            recognizer = LBPHRecognizer()
+            if self.active_classes and manifest.shards:
+                # 只加载选中班级的分片,没有已训练用户的班级不参与
+                shards = [os.path.join('../recognizer', manifest.shards[class_]) for class_ in self.active_classes
+                          if class_ in manifest.shards]
+                if shards:
+                    recognizer.read_shards(shards)
+                self.log_queue.put('load {} histograms of classes {}.'.format(len(recognizer.labels),
+                                                                              ', '.join(self.active_classes)))
+            # 二进制模型直接内存映射
+            elif manifest.binary and os.path.isfile(os.path.join('../recognizer', manifest.binary)):
+                recognizer.read(os.path.join('../recognizer', manifest.binary))
+            else:
+                recognizer.read('../recognizer/trainingData.yml')
+            if self.active_classes and not manifest.shards:
+                self.log_queue.put('Error: model is not sharded by class, recognize users of all classes.')
+        else:
+            if self.active_classes:
+                self.log_queue.put('Error: opencv engine does not support class shards, recognize all classes.')
+            recognizer = cv2.face.LBPHFaceRecognizer_create()
+            recognizer.read('../recognizer/trainingData.yml')
+        return recognizer, manifest.version
+
+    def start_model_watcher(self):
+        """
+        启动模型监视线程,当前模型也由其在后台加载,首帧无需等待
+        :return:
+        """
+        if self.model_watch_interval and self.model_watcher is None:
+            self.model_watcher = ModelWatcher(self, self.model_watch_interval)
+            self.model_watcher.start()
+
+    def set_active_classes(self, classes):
+        """
+        选择参与识别的班级,已加载的模型在后台按新的班级重新加载
+        :param classes: 班级列表,None为全部
+        :return:
+        """
+        self.active_classes = list(classes) if classes else None
+        self.log_queue.put('Success: select classes {}.'.format(', '.join(classes) if classes else 'all'))
+        if self.model_watcher:
+            self.model_watcher.reload()
+        else:
+            self.is_train_data_loaded = False
+
+    def swap_recognizer(self, recognizer, version):
+        """
+        替换识别器,处理线程在下一帧开始使用,正在处理的帧仍使用原识别器
+        :param recognizer: 已加载完成的识别器
+        :param version: 模型版本
+        :return:
+        """
+        self.recognizer = recognizer
+        self.model_version = version
+        DataBase.invalidate_directory()
+        self.log_queue.put('Success: model version {} is active.'.format(version))
+
+    def recognize_frame(self, frame):
+        """
+        检测并识别人脸,不修改图像帧
+        :param frame: 输入的图像帧
+        :return results: [(人脸位置, face_id, 置信度)],未加载训练数据时face_id为None
+        """
+        faces, gray = self.locate_faces(frame)
+        # 加载数据,有模型监视线程时由其在后台加载
+        if self.model_watcher is None:
+            self.load_train_data()
+        if not faces:
+            return []
+        recognizer = self.recognizer  # 本帧始终使用同一个识别器
+        if recognizer is None:
+            return [(face, None, 0) for face in faces]
+        if recognizer is not self.cached_recognizer:
+            # 模型已替换,缓存的身份作废
+            self.identity_cache.clear()
+            self.cached_recognizer = recognizer
+        # 同一跟踪目标优先使用缓存的身份,其余人脸一次批量识别
+        tracks = self.tracker.tracks
+        self.identity_cache.retain([track.track_id for track in tracks])
+        results = []
+        pending = []  # 需要识别的跟踪目标在results中的下标
+        for i, track in enumerate(tracks):
+            cached = self.identity_cache.get(track.track_id, track.box)
+            self.log_identity_cache()
+            if cached:
+                face_id, confidence = cached
+                results.append((track.box, face_id, confidence))
+            else:
+                results.append((track.box, None, 0))
+                pending.append(i)
+        if not pending:
+            return results
+        crops = self.buffer('faces', (len(pending), 200, 200))
+        for i, crop in zip(pending, crops):
+            (x, y, w, h) = tracks[i].box
+            with self.tracer.stage('crop'):
+                cv2.resize(gray[y:y + h, x:x + w], (200, 200), dst=crop)
+        if hasattr(recognizer, 'predict_batch'):
+            predictions = recognizer.predict_batch(crops)
+        else:
+            predictions = [recognizer.predict(crop) for crop in crops]
+        for i, (face_id, confidence) in zip(pending, predictions):
+            face = tracks[i].box
+            self.identity_cache.put(tracks[i].track_id, face, face_id, confidence,
+                                    confidence > self.confidenceThreshold)
+            results[i] = (face, face_id, confidence)
+        return results
+
+    def log_identity_cache(self):
+        """
+        定期记录身份缓存命中情况
+        :return:
+        """
+        stats = self.identity_cache.stats()
+        if (stats['hits'] + stats['misses']) % self.identity_log_interval == 0:
+            self.log_queue.put('identity cache hits: {hits}, misses: {misses}.'.format(**stats))
+
+    def draw_results(self, frame, results):
+        """
+        根据识别结果签到,并在画面帧上标注
+        :param frame: 图像帧
+        :param results: recognize_frame的识别结果
+        :return frame: 标注后的图像帧
+        """
+        labels = []  # 待绘制的文字,最后一次性绘制
+        if results and self.sign_date != date.today():
+            # 新的一天,重新开始签到
+            self.sign_date = date.today()
+            self.signed = self.db.query_signed(self.sign_date)
+        for face, face_id, confidence in results:
             (x, y, w, h) = face
             cv2.rectangle(frame, (x, y), (x + w, y + h), (232, 138, 30), 1)
-            gray = np.array(gray, 'uint8')  # 图片数据转换
-            face_id, confidence = self.recognizer.predict(gray)
+            if face_id is None:
+                continue
             if confidence > self.confidenceThreshold:
-                is_known, stu_id, name, created_time = self.db.query_by_face_id(face_id)
+                is_known, stu_id, name, created_time = self.directory.query_by_face_id(face_id)
                 if is_known:
                     if stu_id :
                         if stu_id not in self.signed:
-                            self.signed.append(stu_id)
-                            self.db.update_sign_time(stu_id)
-                            self.log_queue.put('Success: signed successfully , can go away !')
-                        frame = self.change_cv2_draw(frame, 'stu_id: ' + str(stu_id), (x + w + 5, y), 20, (0, 0, 255))
-                        frame = self.change_cv2_draw(frame, 'face_id: ' + str(face_id), (x + w + 5, y + 25), 20,
-                                                     (0, 0, 255))
-                        frame = self.change_cv2_draw(frame, 'name: ' + str(name), (x + w + 5, y + 50), 20, (0, 0, 255))
-                        frame = self.change_cv2_draw(frame, '签到成功 ', (x + w + 5, y + 75), 20,
-                                                     (0, 0, 255))
+                            self.sign(stu_id)
+                            self.log_queue.put('Success: {} signed successfully , can go away !'.format(stu_id))
+                        labels.append(('stu_id: ' + str(stu_id), (x + w + 5, y), 20, (0, 0, 255)))
+                        labels.append(('face_id: ' + str(face_id), (x + w + 5, y + 25), 20, (0, 0, 255)))
+                        labels.append(('name: ' + str(name), (x + w + 5, y + 50), 20, (0, 0, 255)))
+                        labels.append(('签到成功 ', (x + w + 5, y + 75), 20, (0, 0, 255)))
 
                 else:
-                    frame = self.change_cv2_draw(frame, 'Unknown', (x + w + 5, y), 20, (255, 0, 0))
-        return frame
+                    labels.append(('Unknown', (x + w + 5, y), 20, (255, 0, 0)))
+        return self.overlay.draw(frame, labels)
+
+    def sign(self, stu_id):
+        """
+        签到,由签到写入线程批量写入数据库
+        :param stu_id: 用户学号
+        :return:
+        """
+        if self.sign_writer is None:
+            self.sign_writer = SignWriter(self.db)
+            self.sign_writer.start()
+        self.signed.add(stu_id)
+        self.sign_writer.put(stu_id)
+
+    def face_detect_update(self, frame=None):
+        """
+        检测人脸,识别信息,更新输出
+        :param frame: 输入的图像帧,默认读取最新帧
+        :return frame: 处理过得画面帧,进程池模式下暂无结果时为None
+        """
+        if frame is None:
+            frame = self.read_frame()
+            if frame is None:
+                return None
+        is_busy = bool(self.tracker.tracks or self.pool_faces)
+        if self.motion_gate is not None and not self.motion_gate.check(frame, is_busy):
+            return frame  # 画面静止且没有跟踪中的人脸,只显示不检测
+        if self.pipeline_workers > 0:
+            return self.pipeline_update(frame)
+        results = self.recognize_frame(frame)
+        return self.draw_results(frame, results)
+
+    def pipeline_update(self, frame):
+        """
+        进程池模式:提交图像帧,按帧序号取回识别结果
+        :param frame: 输入的图像帧
+        :return frame: 按顺序返回的已处理画面帧,暂无结果时为None
+        """
+        if self.pool is not None and self.pool.active_classes != self.active_classes:
+            # 班级变化,检测进程按新的班级重新启动
+            self.pool.close()
+            self.pool = None
+        if self.pool is None:
+            self.pool = DetectionPool(self.pipeline_workers, frame.shape, self.log_queue, self.active_classes)
+        if frame.shape != self.pool.frame_shape:
+            return self.draw_results(frame, self.recognize_frame(frame))
+        self.pool.submit(frame)
+        try:
+            # 进程全部忙碌时等待最早的结果,否则继续提交新帧
+            item = self.pool.get(block=self.pool.in_flight() >= self.pool.workers, timeout=1)
+        except WorkerDied:
+            # 检测进程异常退出,关闭进程池,改为在处理线程内完成
+            self.log_queue.put('Error: detection worker exited, process frames in this thread.')
+            self.pool.close()
+            self.pool = None
+            self.pool_faces = []
+            self.pipeline_workers = 0
+            self.start_model_watcher()
+            return self.draw_results(frame, self.recognize_frame(frame))
+        if item is None:
+            return None
+        seq, frame, results = item
+        self.pool_faces = [face for face, face_id, confidence in results]
+        return self.draw_results(frame, results)
 
-    def prepare_train_data(self, data_folder_path):
+    def assign_train_face_ids(self, data_folder_path, reserved=0):
         """
-        准备训练数据
+        为数据集中的用户分配face_id
         :param data_folder_path: 文件目录
-        :returns faces,labels: 人脸数据,标签
+        :param reserved: 已分配过的最大face_id,新用户从其之后分配
+        :return face_ids: {stu_id: face_id},数据库出错时为None
         """
-        dirs = os.listdir(data_folder_path)
+        # 一次性分配face_id,已训练过的用户保持原有face_id
+        return self.db.assign_face_ids(FaceStore(self.log_queue, data_folder_path).list_subjects(), reserved)
 
-        faces = []
-        labels = []
-        face_id = 1
-        for dir_name in dirs:
-            if not dir_name.startswith('stu_'):
-                continue
-            stu_id = dir_name.replace('stu_', '')
-            self.db.update_face_id(stu_id, face_id)  # 更新face_id
-            subject_dir_path = os.path.join(data_folder_path, dir_name)
-            subject_images_names = os.listdir(subject_dir_path)
-            for image_name in subject_images_names:
-                if image_name.startswith('.'):
-                    continue
-                image_path = os.path.join(subject_dir_path, image_name)
-                image = Image.open(image_path).convert('L')
-                image = np.array(image, 'uint8')
-                faces.append(image)
-                labels.append(face_id)
-        face_id += 1
-        return faces, labels
-
-    def train(self):
-        """
-        训练数据
+    def fit_recognizer(self, face_recognizer, items, cancel_event=None):
+        """
+        分批加载图片训练识别器,第一批train,其余批次update
+        :param face_recognizer: 识别器
+        :param items: [(图片路径, face_id)]
+        :param cancel_event: 取消事件
+        :return is_fitted: 是否有数据参与训练
+        """
+        loader = DatasetLoader(self.log_queue, cancel_event=cancel_event)
+        is_fitted = False
+        for faces, labels in loader.iter_chunks(items):
+            if is_fitted:
+                face_recognizer.update(faces, labels)
+            else:
+                face_recognizer.train(faces, labels)
+            is_fitted = True
+        return is_fitted
+
+    def train(self, incremental=False, cancel_event=None):
+        """
+        训练数据,模型在内存中更新,全部完成后一次写入并发布
+        :param incremental: 增量训练,只计算新增及数据变化的用户,移除的用户直接从模型中删除
+        :param cancel_event: 取消事件,设置后停止训练,已保存的模型不变
         :return is_trained: 是否训练成功
         """
         is_trained = True
+        self.train_lock.acquire()  # 同一时间只有一个训练任务写入模型
         try:
             # 人脸数据集合
             if not os.path.exists('../dataset'):
                 raise FileNotFoundError
-            face_recognizer = cv2.face.LBPHFaceRecognizer_create()
-            faces, labels = self.prepare_train_data('../dataset')
-
-            face_recognizer.train(faces, np.array(labels))
-            face_recognizer.save('../recognizer/trainingData.yml')  # 保存
+            manifest = TrainManifest()
+            is_manifest_loaded = manifest.load()
+            # 已删除用户的face_id可能仍留在模型中,不再分配给新用户
+            face_ids = self.assign_train_face_ids('../dataset', manifest.max_face_id)
+            if face_ids is None:
+                # 不能当作没有用户,否则已训练的用户全部被删除
+                raise ValueError('can not assign face_id')
+            if incremental and not (os.path.isfile('../recognizer/trainingData.yml') and is_manifest_loaded):
+                self.log_queue.put('can not found trained model or manifest, train all face data.')
+                incremental = False
+            added, changed, removed, signatures = manifest.diff('../dataset', face_ids)
+            if incremental:
+                if not (added or changed or removed):
+                    self.log_queue.put('Success: trained model is up to date.')
+                    return is_trained
+                model = self.read_model(manifest)
+                if changed or removed:
+                    # 从内存中的模型删除变化及移除的用户,变化的用户再重新追加
+                    self.log_queue.put('{} users changed, {} users removed.'.format(len(changed), len(removed)))
+                    model.remove_labels([manifest.subjects.pop(stu_id)['face_id'] for stu_id in changed + removed])
+                    added += changed
+                if added:
+                    # 只计算追加用户的直方图,参数与已有模型相同
+                    face_recognizer = cv2.face.LBPHFaceRecognizer_create(radius=model.radius, neighbors=model.neighbors,
+                                                                         grid_x=model.grid_x, grid_y=model.grid_y)
+                    added_face_ids = {stu_id: face_ids[stu_id] for stu_id in added}
+                    if self.fit_recognizer(face_recognizer, DatasetLoader.list_images('../dataset', added_face_ids),
+                                           cancel_event):
+                        model.extend(LBPHModel.from_recognizer(face_recognizer))
+                    manifest.update(added_face_ids, signatures)
+                    self.log_queue.put('add {} users to trained model.'.format(len(added)))
+            else:
+                face_recognizer = cv2.face.LBPHFaceRecognizer_create()
+                if not self.fit_recognizer(face_recognizer, DatasetLoader.list_images('../dataset', face_ids),
+                                           cancel_event):
+                    raise ValueError('empty dataset')
+                model = LBPHModel.from_recognizer(face_recognizer)
+                manifest.subjects = {}
+                manifest.update(face_ids, signatures)
+            if self.prototypes_per_subject:
+                self.condense_model(model)
+            self.save_model(manifest, model)
         except FileNotFoundError:
             self.log_queue.put('Error: can not found face data dir {}'.format('../dataset'))
             is_trained = False
+        except TrainCancelled:
+            self.log_queue.put('Error: train cancelled, trained model is not changed.')
+            is_trained = False
         except Exception as e:
             self.log_queue.put('Error: failed to train.')
             is_trained = False
         else:
             self.log_queue.put('Success: train finished successful.')
+        finally:
+            self.train_lock.release()
         return is_trained
 
+    def read_model(self, manifest):
+        """
+        读取当前发布的模型,有二进制模型时直接读取,无需解析YAML
+        :param manifest: 训练清单
+        :return model: LBPHModel
+        """
+        if manifest.binary and os.path.isfile(os.path.join('../recognizer', manifest.binary)):
+            return ModelFile.open(os.path.join('../recognizer', manifest.binary)).to_model()
+        return LBPHModel.read_yaml('../recognizer/trainingData.yml')
+
+    def save_model(self, manifest, model):
+        """
+        写入YAML模型并发布,二进制模型由同一个LBPHModel写出
+        :param manifest: 训练清单
+        :param model: LBPHModel,没有直方图时删除模型
+        :return:
+        """
+        if len(model.labels):
+            model.write_yaml('../recognizer/trainingData.yml')
+            self.publish_model(manifest, ModelFile.from_model(model))
+        else:
+            os.remove('../recognizer/trainingData.yml')  # 没有剩余用户
+            self.publish_model(manifest, None)
+        DataBase.invalidate_directory()
+
+    def publish_model(self, manifest, model_file):
+        """
+        发布新版本模型:二进制模型按版本号写入新文件,最后保存清单,清单中的版本号变化即为发布。
+        旧版本文件可能仍被其他进程映射,删除失败时保留到下次发布
+        :param manifest: 训练清单
+        :param model_file: 二进制模型,None为没有模型
+        :return:
+        """
+        manifest.version += 1
+        manifest.binary = None
+        manifest.shards = {}
+        if model_file is not None:
+            manifest.binary = 'trainingData.{}.bin'.format(manifest.version)
+            model_file.write(os.path.join('../recognizer', manifest.binary))
+            if self.shard_by_class:
+                manifest.shards = self.write_shards(model_file, manifest.version)
+        manifest.save()
+        names = {manifest.binary} | set(manifest.shards.values())
+        for name in os.listdir('../recognizer'):
+            if name.startswith('trainingData.') and name.endswith('.bin') and name not in names:
+                try:
+                    os.remove(os.path.join('../recognizer', name))
+                except OSError:
+                    pass
+        self.log_queue.put('Success: publish model version {}.'.format(manifest.version))
+
+    def write_shards(self, model_file, version):
+        """
+        按用户所在班级拆分模型,每个班级一个分片
+        :param model_file: 二进制模型
+        :param version: 模型版本
+        :return shards: {班级: 分片文件名}
+        """
+        face_classes = self.db.load_face_classes()
+        labels, inverse = np.unique(model_file.labels, return_inverse=True)
+        classes = np.array([face_classes.get(int(label), '') for label in labels], dtype=object)[inverse]
+        shards = {}
+        for i, class_ in enumerate(sorted(set(classes))):
+            shards[class_] = 'trainingData.{}.shard{}.bin'.format(version, i)
+            model_file.select(np.flatnonzero(classes == class_)).write(os.path.join('../recognizer', shards[class_]))
+        self.log_queue.put('split model into {} class shards.'.format(len(shards)))
+        return shards
+
+    def condense_model(self, model):
+        """
+        精简模型,每个用户只保留prototypes_per_subject个代表直方图,记录精简前后的模型大小及留一法准确率
+        :param model: LBPHModel,在内存中精简
+        :return:
+        """
+        histograms, labels = model.histograms, model.labels
+        kept = model.condense(self.prototypes_per_subject)
+        if len(kept) == len(labels):
+            return
+        self.log_queue.put('condense model from {} to {} histograms, {:.1f} MB to {:.1f} MB.'.format(
+            len(labels), len(kept), histograms.nbytes / 1024 / 1024, model.histograms.nbytes / 1024 / 1024))
+        if self.condense_eval_samples:
+            rows = np.sort(np.random.default_rng(0).choice(len(labels), min(self.condense_eval_samples, len(labels)),
+                                                           replace=False))
+            probes = histograms[rows].copy()
+            positions = np.full(len(labels), -1)
+            positions[kept] = np.arange(len(kept))  # 保留的直方图在精简后模型中的下标
+            full = LBPHRecognizer()
+            full.set_histograms(histograms, labels)
+            before = full.leave_one_out(probes, labels[rows], rows)
+            after = LBPHRecognizer.from_model(model).leave_one_out(probes, labels[rows], positions[rows])
+            self.log_queue.put('leave-one-out accuracy of {} samples: {:.1%} before condense, {:.1%} after.'.format(
+                len(rows), before, after))
+
+    def remove_subjects(self, stu_ids):
+        """
+        从已训练的模型中删除用户的全部直方图,无需重新训练。持有训练锁,应在TrainThread中调用
+        :param stu_ids: 用户学号
+        :return is_removed: 是否删除成功,没有训练清单或用户不在清单中时为False,需要重新训练
+        """
+        is_removed = True
+        self.train_lock.acquire()  # 与训练互斥,避免同时写入模型及清单
+        try:
+            manifest = TrainManifest()
+            if not (os.path.isfile('../recognizer/trainingData.yml') and manifest.load()):
+                raise FileNotFoundError
+            missing = [stu_id for stu_id in stu_ids if stu_id not in manifest.subjects]
+            if missing:
+                raise RecordNotFound(missing)
+            model = self.read_model(manifest)
+            removed = model.remove_labels([manifest.subjects.pop(stu_id)['face_id'] for stu_id in stu_ids])
+            self.save_model(manifest, model)
+        except FileNotFoundError:
+            self.log_queue.put('Error: can not found trained model or manifest, please train again.')
+            is_removed = False
+        except RecordNotFound as e:
+            self.log_queue.put('Error: {} not in trained model manifest.'.format(', '.join(e.args[0])))
+            is_removed = False
+        except Exception as e:
+            self.log_queue.put('Error: can not remove {} from trained model.'.format(', '.join(stu_ids)))
+            is_removed = False
+        else:
+            self.log_queue.put('Success: remove {} histograms of {} from trained model.'.format(removed,
+                                                                                               ', '.join(stu_ids)))
+        finally:
+            self.train_lock.release()
+        return is_removed
+
     def start_camera(self, status, timer):
         """
         打开摄像头,启动定时器,更新画面
@@ -172,27 +706,68 @@ class FaceProcess(object):
         """
         is_camera_ok = True
         if status:
-            if not self.cap.isOpened():
-                self.cap.open(cv2.CAP_DSHOW + 0)
-                # self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                # self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 511)
+            open_camera(self.cap)
+            # self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            # self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 511)
             ret, frame = self.cap.read()
             if not ret:
                 is_camera_ok = False
                 self.log_queue.put('Error: can not open camera, please check it.')
                 self.cap.release()
             else:
-                timer.start(5)  # 启动定时器
+                self.start_capture()
+                timer.start(self.paint_interval)  # 启动定时器,只负责绘制
                 self.log_queue.put('Success: camera opened, start the timer.')
             return is_camera_ok
         else:
             if self.cap.isOpened():
                 if timer.isActive():
                     timer.stop()
-                self.cap.release()
+                self.stop_camera()
                 self.log_queue.put('Error: have not opened camera.')
             return False
 
+    def stop_camera(self):
+        """
+        停止处理线程及采集线程,释放摄像头
+        :return:
+        """
+        if self.frame_worker:
+            self.frame_worker.stop()
+            self.frame_worker = None
+        if self.capture_thread:
+            self.capture_thread.stop()
+            self.capture_thread = None
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+            self.pool_faces = []
+        if self.sign_writer:
+            self.sign_writer.stop()
+            self.sign_writer = None
+        if self.record_writer:
+            self.record_writer.finish()  # 保存已采集的部分
+            self.record_writer = None
+        if self.model_watcher:
+            self.model_watcher.stop()
+            self.model_watcher = None
+        self.cap.release()
+        self.log_queue.put('frames captured: {captured}, processed: {processed}, dropped: {dropped}.'.format(
+            **self.frame_buffer.stats()))
+        self.log_queue.put('face boxes from detection: {detect} frames, from tracking: {track} frames.'.format(
+            **self.scheduler.stats()))
+        self.log_queue.put('detection scanned {scanned:.0%} of frame pixels, {full_scans} full scans.'.format(
+            **self.region.stats()))
+        self.log_queue.put('identity cache hits: {hits}, misses: {misses}.'.format(**self.identity_cache.stats()))
+        if self.tracer.enabled:
+            self.log_queue.put('preprocess allocations per frame: {allocations:.1f}, {allocated_kb:.0f} KB, peak '
+                               'memory {peak_kb:.0f} KB per frame, latency {latency_ms:.1f} ± {jitter_ms:.1f} ms, '
+                               '{collections} gc collections in {frames} frames.'.format(**self.tracer.stats()))
+        if self.motion_gate is not None:
+            self.log_queue.put('motion gate idle {idle:.0f} s at {idle_cpu:.1%} cpu, active {active:.0f} s at '
+                               '{active_cpu:.1%} cpu, {wakeups} wakeups in {wake_ms:.0f} ms on average, '
+                               '{max_wake_ms:.0f} ms at most.'.format(**self.motion_gate.stats()))
+
     def start_face_record(self, stu_id, label):
         """
         开始采集脸部数据
@@ -201,19 +776,22 @@ class FaceProcess(object):
         :return:
         """
         is_face_record = True
+        frame = self.read_frame(timeout=0)
+        if frame is None:
+            return
+        self.frame_buffer.mark_processed()
         if self.face_record_num < self.min_face_record_num:
-            if not self.cap.isOpened():
-                self.cap.open(cv2.CAP_DSHOW + 0)
-            ret, frame = self.cap.read()
             face, gray = self.detect_face(frame)
             try:
-                if not os.path.exists('{}/stu_{}'.format('../dataset', stu_id)):
-                    os.makedirs('{}/stu_{}'.format('../dataset', stu_id))
+                if self.record_writer is None:
+                    # 预分配整个用户的人脸数组,采集完成后一次性替换旧数据
+                    self.record_writer = FaceStore(self.log_queue).writer(stu_id, self.min_face_record_num)
                 if face:
                     x, y, w, h = face
-                    gray = cv2.resize(gray, (200, 200))
-                    cv2.imwrite('{}/stu_{}/img.{}.jpg'.format('../dataset', stu_id, self.face_record_num + 1),
-                                gray)
+                    crop = self.buffer('faces', (1, 200, 200))[0]
+                    with self.tracer.stage('crop'):
+                        cv2.resize(gray, (200, 200), dst=crop)
+                    self.record_writer.write(crop)
                     if self.face_record_num % 10 == 0:
                         self.log_queue.put('collect {} images, {} are need.'.format(self.face_record_num + 1,
                                                                                     self.min_face_record_num))
@@ -227,22 +805,40 @@ class FaceProcess(object):
                     cv2.rectangle(frame, (x - 5, y - 5), (x + w + 10, y + h + 10), (0, 0, 255), 2)
                 self.display_image(frame, label)  # 展示数据
         else:
-            ret, frame = self.cap.read()
+            if self.record_writer:
+                self.record_writer.finish()
+                self.log_queue.put('Success: save {} images of {}.'.format(self.record_writer.count, stu_id))
+                self.record_writer = None
             self.face_record_num += 1
             self.display_image(frame, label)  # 展示原本画面帧
 
     def update_frame(self, label):
         """
-        展示画面帧到指定位置,在core中使用
+        展示画面帧到指定位置,在core中使用,处理在后台线程完成,此处只绘制
         :param label: 控件
         :return:
         """
         if self.cap.isOpened():
-            real_time_frame = self.face_detect_update()
-            self.display_image(real_time_frame, label)
+            if self.frame_worker is None or not self.frame_worker.is_alive():
+                self.start_capture()
+                self.frame_worker = FrameWorker(self.frame_buffer, self.face_detect_update, self.log_queue,
+                                                self.motion_gate, self.tracer)
+                self.frame_worker.start()
+                if not self.pipeline_workers:
+                    self.start_model_watcher()  # 多进程时由各检测进程自行监视
+            seq, real_time_frame = self.frame_worker.latest_result()
+            if real_time_frame is not None and seq != self.painted_seq:
+                self.painted_seq = seq
+                self.display_image(real_time_frame, label)
 
     @staticmethod
     def display_image(img, label):
+        # Qt 5.14起可直接显示BGR图像,QPixmap.fromImage会复制一次,无需先转换颜色
+        if len(img.shape) == 3 and img.shape[2] == 3 and hasattr(QImage, 'Format_BGR888'):
+            out_image = QImage(img, img.shape[1], img.shape[0], img.strides[0], QImage.Format_BGR888)
+            label.setPixmap(QPixmap.fromImage(out_image))
+            label.setScaledContents(True)  # 图片自适应大小
+            return
         # BGR -> RGB
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         # default：The image is stored using 8-bit indexes into a colormap， for example：a gray image
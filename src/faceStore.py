@@ -0,0 +1,197 @@
+import json
+import os
+import queue
+import shutil
+
+import cv2
+import numpy as np
+
+
+class FaceStore(object):
+    """
+    紧凑的人脸数据存储,每个用户的200x200灰度人脸保存为一个连续的.npy数组,另有index.json索引,
+    训练时以内存映射方式读取;兼容旧的stu_<id>/img.N.jpg目录
+    """
+    face_size = (200, 200)  # 人脸图像尺寸
+
+    def __init__(self, log_queue, root='../dataset'):
+        self.log_queue = log_queue
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+
+    def load_index(self):
+        """
+        :return index: {stu_id: {'file': 文件名, 'count': 图片数量}}
+        """
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def folder_path(self, stu_id):
+        return os.path.join(self.root, 'stu_{}'.format(stu_id))
+
+    def packed_path(self, stu_id):
+        return os.path.join(self.root, 'stu_{}.npy'.format(stu_id))
+
+    def list_subjects(self):
+        """
+        列出所有有人脸数据的用户,包括旧的图片目录
+        :return stu_ids: 学号列表
+        """
+        stu_ids = set(self.load_index())
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name.startswith('stu_'):
+                stu_ids.add(entry.name.replace('stu_', '', 1))
+        return sorted(stu_ids)
+
+    def is_packed(self, stu_id, index=None):
+        index = self.load_index() if index is None else index
+        return stu_id in index and os.path.isfile(self.packed_path(stu_id))
+
+    def load(self, stu_id):
+        """
+        以内存映射方式读取用户人脸数据,不复制
+        :param stu_id: 学号
+        :return faces: (图片数量, 200, 200) uint8
+        """
+        return np.load(self.packed_path(stu_id), mmap_mode='r')
+
+    def signature(self, stu_id, index=None):
+        """
+        人脸数据的特征,重新采集或增删图片后会变化
+        :param stu_id: 学号
+        :param index: 已读取的索引
+        :return signature: [图片数量, 最新修改时间]
+        """
+        index = self.load_index() if index is None else index
+        if self.is_packed(stu_id, index):
+            return [index[stu_id]['count'], os.path.getmtime(self.packed_path(stu_id))]
+        count, latest = 0, 0.0
+        for entry in os.scandir(self.folder_path(stu_id)):
+            if entry.name.startswith('.'):
+                continue
+            count += 1
+            latest = max(latest, entry.stat().st_mtime)
+        return [count, latest]
+
+    def writer(self, stu_id, capacity):
+        """
+        :param stu_id: 学号
+        :param capacity: 最多采集的图片数量
+        :return writer: FaceRecordWriter
+        """
+        os.makedirs(self.root, exist_ok=True)
+        return FaceRecordWriter(self, stu_id, capacity)
+
+    def publish(self, stu_id, tmp_path, count):
+        """
+        采集完成后替换用户的人脸数据并更新索引,旧的图片目录一并删除
+        :param stu_id: 学号
+        :param tmp_path: 已写好的临时文件
+        :param count: 图片数量
+        :return:
+        """
+        os.replace(tmp_path, self.packed_path(stu_id))
+        index = self.load_index()
+        index[stu_id] = {'file': os.path.basename(self.packed_path(stu_id)), 'count': count}
+        self.save_index(index)
+        if os.path.isdir(self.folder_path(stu_id)):
+            shutil.rmtree(self.folder_path(stu_id))
+
+    def remove(self, stu_id):
+        """
+        删除用户的人脸数据,包括旧的图片目录
+        :param stu_id: 学号
+        :return:
+        """
+        index = self.load_index()
+        if index.pop(stu_id, None) is not None:
+            self.save_index(index)
+        if os.path.isfile(self.packed_path(stu_id)):
+            os.remove(self.packed_path(stu_id))
+        if os.path.isdir(self.folder_path(stu_id)):
+            shutil.rmtree(self.folder_path(stu_id))
+
+    def migrate_folders(self):
+        """
+        把旧的stu_<id>/img.N.jpg目录转换为紧凑格式,转换成功后删除原目录
+        :return migrated: 转换的用户数量
+        """
+        migrated = 0
+        for stu_id in self.list_subjects():
+            folder = self.folder_path(stu_id)
+            if not os.path.isdir(folder):
+                continue
+            names = sorted(name for name in os.listdir(folder) if not name.startswith('.'))
+            writer = self.writer(stu_id, len(names))
+            for name in names:
+                image = cv2.imread(os.path.join(folder, name), cv2.IMREAD_GRAYSCALE)
+                if image is None:
+                    self.log_queue.put('Error: can not read image {}.'.format(os.path.join(folder, name)))
+                    continue
+                if image.shape != self.face_size:
+                    image = cv2.resize(image, self.face_size[::-1])
+                writer.write(image)
+            writer.finish()
+            migrated += 1
+            self.log_queue.put('Success: migrate {} images of {} to {}.'.format(writer.count, stu_id,
+                                                                                self.packed_path(stu_id)))
+        return migrated
+
+
+class FaceRecordWriter(object):
+    """
+    逐张写入人脸数据到预分配的内存映射文件,完成后一次性发布
+    """
+
+    def __init__(self, store, stu_id, capacity):
+        self.store = store
+        self.stu_id = stu_id
+        self.count = 0  # 已写入数量
+        self.tmp_path = store.packed_path(stu_id) + '.tmp'
+        self.faces = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=np.uint8,
+                                               shape=(max(capacity, 1),) + store.face_size)
+
+    def write(self, face):
+        """
+        :param face: 200x200灰度人脸
+        :return:
+        """
+        if self.count < len(self.faces):
+            self.faces[self.count] = face
+            self.count += 1
+
+    def finish(self):
+        """
+        写入完成,采集数量不足时截断
+        :return:
+        """
+        self.faces.flush()
+        if self.count == len(self.faces):
+            del self.faces
+            self.store.publish(self.stu_id, self.tmp_path, self.count)
+            return
+        faces = np.array(self.faces[:self.count])
+        del self.faces
+        os.remove(self.tmp_path)
+        if self.count == 0:
+            return
+        np.save(self.tmp_path, faces)  # np.save会追加.npy扩展名
+        self.store.publish(self.stu_id, self.tmp_path + '.npy', self.count)
+
+
+if __name__ == '__main__':
+    # 转换旧的人脸数据目录
+    log_queue = queue.Queue()
+    count = FaceStore(log_queue).migrate_folders()
+    while not log_queue.empty():
+        print(log_queue.get())
+    print('{} users migrated.'.format(count))
@@ -0,0 +1,218 @@
+import sys
+
+import numpy as np
+from src.model import LBPHModel
+from src.modelFile import ModelFile
+
+
+class LBPHRecognizer(object):
+    """
+    NumPy实现的LBPH识别器,与LBPHFaceRecognizer的read/predict用法相同,直方图与OpenCV逐位一致。
+    全部样本直方图及其平方根各保存在一个连续的float32矩阵中,先用一次矩阵乘法求出所有样本卡方距离的下界,
+    再只对下界不超过当前最近距离的样本计算精确距离;多张人脸共用一次矩阵乘法
+    """
+    batch_size = 64  # 每批计算的人脸数量
+    refine_size = 32  # 每次计算精确距离的样本数量
+    bound_margin = 0.05  # 下界的浮点误差余量,矩阵乘法以float32累加
+
+    def __init__(self, radius=1, neighbors=8, grid_x=8, grid_y=8, threshold=sys.float_info.max):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.threshold = threshold
+        self.histograms = np.zeros((0, grid_x * grid_y * 2 ** neighbors), np.float32)  # (样本数, 维度)
+        self.roots = np.zeros_like(self.histograms)  # 直方图的平方根,用于计算距离下界
+        self.sums = np.zeros(0)  # 每个直方图的元素和
+        self.labels = np.zeros(0, np.int32)  # (样本数,)
+        self.refined = 0  # 已计算精确距离的样本数,用于评估下界的剪枝效果
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        :param model: LBPHModel
+        :return recognizer: LBPHRecognizer
+        """
+        recognizer = cls(model.radius, model.neighbors, model.grid_x, model.grid_y, model.threshold)
+        recognizer.set_histograms(model.histograms, model.labels)
+        return recognizer
+
+    def read(self, path):
+        """
+        读取模型,.bin为内存映射的二进制模型,其他为LBPHFaceRecognizer保存的YAML
+        :param path: 模型文件
+        :return:
+        """
+        if path.endswith('.bin'):
+            self.read_shards([path])
+            return
+        model = LBPHModel.read_yaml(path)
+        self.radius, self.neighbors, self.grid_x, self.grid_y = model.radius, model.neighbors, model.grid_x, model.grid_y
+        self.threshold = model.threshold
+        self.set_histograms(model.histograms, model.labels)
+
+    def read_shards(self, paths):
+        """
+        读取多个二进制模型分片并合并,只有一个分片时直接内存映射,不复制
+        :param paths: 二进制模型文件列表,参数相同
+        :return:
+        """
+        model_files = [ModelFile.open(path) for path in paths]
+        header = model_files[0].header
+        self.radius, self.neighbors = header['radius'], header['neighbors']
+        self.grid_x, self.grid_y, self.threshold = header['grid_x'], header['grid_y'], header['threshold']
+        if len(model_files) == 1:
+            self.histograms, self.roots = model_files[0].histograms, model_files[0].roots
+            self.sums, self.labels = model_files[0].sums, model_files[0].labels
+            return
+        self.histograms = np.concatenate([model_file.histograms for model_file in model_files])
+        self.roots = np.concatenate([model_file.roots for model_file in model_files])
+        self.sums = np.concatenate([model_file.sums for model_file in model_files])
+        self.labels = np.concatenate([model_file.labels for model_file in model_files])
+
+    def set_histograms(self, histograms, labels):
+        """
+        :param histograms: (样本数, 维度) float32
+        :param labels: (样本数,)
+        :return:
+        """
+        self.histograms = np.ascontiguousarray(histograms, np.float32)
+        self.roots = np.sqrt(self.histograms)
+        self.sums = self.histograms.sum(axis=1, dtype=np.float64)
+        self.labels = np.asarray(labels, np.int32).ravel()
+
+    def lbp(self, images):
+        """
+        圆形LBP编码,双线性插值,与OpenCV的elbp计算顺序一致
+        :param images: (数量, 高, 宽) 灰度图
+        :return codes: (数量, 高-2*radius, 宽-2*radius) int32
+        """
+        src = images.astype(np.float32)
+        rows, cols = src.shape[-2:]
+        r = self.radius
+        center = src[:, r:rows - r, r:cols - r]
+        codes = np.zeros(center.shape, np.int32)
+        one = np.float32(1)
+        for n in range(self.neighbors):
+            x = np.float32(r * np.cos(2.0 * np.pi * n / float(self.neighbors)))
+            y = np.float32(-r * np.sin(2.0 * np.pi * n / float(self.neighbors)))
+            fx, fy, cx, cy = int(np.floor(x)), int(np.floor(y)), int(np.ceil(x)), int(np.ceil(y))
+            ty, tx = y - np.float32(fy), x - np.float32(fx)
+            w1, w2, w3, w4 = (one - tx) * (one - ty), tx * (one - ty), (one - tx) * ty, tx * ty
+            t = (w1 * src[:, r + fy:rows - r + fy, r + fx:cols - r + fx] +
+                 w2 * src[:, r + fy:rows - r + fy, r + cx:cols - r + cx] +
+                 w3 * src[:, r + cy:rows - r + cy, r + fx:cols - r + fx] +
+                 w4 * src[:, r + cy:rows - r + cy, r + cx:cols - r + cx])
+            bit = (t > center) | (np.abs(t - center) < np.finfo(np.float32).eps)
+            codes |= bit.astype(np.int32) << n
+        return codes
+
+    def compute_histograms(self, images):
+        """
+        分块LBP直方图,每块按像素数归一化
+        :param images: (数量, 高, 宽) 灰度图,尺寸相同
+        :return histograms: (数量, 维度) float32
+        """
+        codes = self.lbp(images)
+        count, rows, cols = codes.shape
+        height, width = rows // self.grid_y, cols // self.grid_x
+        cells = codes[:, :height * self.grid_y, :width * self.grid_x].reshape(
+            count, self.grid_y, height, self.grid_x, width).transpose(0, 1, 3, 2, 4).reshape(count, -1, height * width)
+        patterns = 2 ** self.neighbors
+        offsets = np.arange(count * self.grid_x * self.grid_y).reshape(count, -1, 1) * patterns
+        hist = np.bincount((cells + offsets).ravel(), minlength=count * self.grid_x * self.grid_y * patterns)
+        return (hist.astype(np.float32) * np.float32(1.0 / (height * width))).reshape(count, -1)
+
+    def distance_bounds(self, histograms):
+        """
+        卡方距离的下界,由调和平均数不大于几何平均数得到: 2*(Sg+Sq) - 4*sqrt(g)·sqrt(q)
+        :param histograms: (数量, 维度)
+        :return bounds: (数量, 样本数)
+        """
+        dots = np.sqrt(histograms) @ self.roots.T
+        return 2 * (self.sums + histograms.sum(axis=1, dtype=np.float64)[:, np.newaxis]) - 4 * dots
+
+    def chi_square(self, histogram, rows):
+        """
+        与HISTCMP_CHISQR_ALT相同的距离
+        :param histogram: 待识别直方图
+        :param rows: 样本下标
+        :return distances: (len(rows),)
+        """
+        samples = self.histograms[rows]
+        total = samples + (histogram + np.float32(1e-30))  # 两者都为0的维度结果为0,无需判断
+        samples -= histogram
+        samples *= samples
+        samples /= total
+        self.refined += len(rows)
+        return 2 * samples.sum(axis=1, dtype=np.float64)
+
+    def nearest(self, histogram, bounds):
+        """
+        按下界从小到大分块计算精确距离,下界超过当前最近距离时停止
+        :param histogram: 待识别直方图
+        :param bounds: 该直方图与所有样本的距离下界
+        :returns label,confidence: 标签,距离;超过阈值时为-1
+        """
+        order = np.argsort(bounds, kind='stable')
+        best, best_row = np.inf, -1
+        for start in range(0, len(order), self.refine_size):
+            rows = order[start:start + self.refine_size]
+            rows = rows[bounds[rows] <= best + self.bound_margin]
+            if not len(rows):
+                break
+            distances = self.chi_square(histogram, rows)
+            distance = distances.min()
+            row = rows[distances == distance].min()  # 距离相同时取下标最小的样本,与OpenCV一致
+            if distance < best or (distance == best and row < best_row):
+                best, best_row = distance, row
+        if not best < self.threshold:
+            return -1, sys.float_info.max
+        return int(self.labels[best_row]), float(best)
+
+    def leave_one_out(self, histograms, labels, rows):
+        """
+        留一法识别准确率,待识别直方图本身不参与匹配
+        :param histograms: 待识别直方图
+        :param labels: 真实标签
+        :param rows: 各直方图在样本中的下标,不在样本中为-1
+        :return accuracy: 识别正确的比例
+        """
+        correct = 0
+        for start in range(0, len(histograms), self.batch_size):
+            bounds = self.distance_bounds(histograms[start:start + self.batch_size])
+            for i, bound in enumerate(bounds, start):
+                if rows[i] >= 0:
+                    bound[rows[i]] = np.inf
+                correct += self.nearest(histograms[i], bound)[0] == labels[i]
+        return correct / max(len(histograms), 1)
+
+    def predict(self, image):
+        """
+        :param image: 灰度人脸
+        :returns label,confidence: 与LBPHFaceRecognizer.predict相同
+        """
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images):
+        """
+        批量识别
+        :param images: 灰度人脸列表,尺寸可以不同
+        :return results: [(label, confidence)]
+        """
+        if not len(self.labels):
+            return [(-1, sys.float_info.max)] * len(images)
+        histograms = np.zeros((len(images), self.roots.shape[1]), np.float32)
+        shapes = {}
+        for i, image in enumerate(images):
+            shapes.setdefault(image.shape, []).append(i)
+        for indexes in shapes.values():
+            for start in range(0, len(indexes), self.batch_size):
+                batch = indexes[start:start + self.batch_size]
+                histograms[batch] = self.compute_histograms(np.stack([images[i] for i in batch]))
+        results = []
+        for start in range(0, len(images), self.batch_size):
+            bounds = self.distance_bounds(histograms[start:start + self.batch_size])
+            for histogram, bound in zip(histograms[start:start + self.batch_size], bounds):
+                results.append(self.nearest(histogram, bound))
+        return results
@@ -0,0 +1,219 @@
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+from src.faceStore import FaceStore
+
+
+class TrainManifest(object):
+    """
+    训练清单,记录模型中包含的用户及其人脸数据的特征,用于增量训练
+    """
+
+    def __init__(self, path='../recognizer/manifest.json'):
+        self.path = path
+        self.subjects = {}  # stu_id -> {'face_id': face_id, 'signature': [图片数量, 最新修改时间]}
+        self.version = 0  # 模型版本,每次发布加1
+        self.binary = None  # 当前版本的二进制模型文件名
+        self.shards = {}  # 班级 -> 当前版本该班级的二进制模型分片文件名
+        self.max_face_id = 0  # 分配过的最大face_id,只增不减
+
+    def load(self):
+        """
+        :return is_loaded: 是否成功读取
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.subjects = manifest['subjects']
+        except (OSError, ValueError, KeyError):
+            self.subjects = {}
+            return False
+        self.version = manifest.get('version', 0)
+        self.binary = manifest.get('binary')
+        self.shards = manifest.get('shards', {})
+        self.max_face_id = manifest.get('max_face_id', max([subject['face_id'] for subject in self.subjects.values()]
+                                                           + [0]))
+        return True
+
+    def save(self):
+        """
+        写入临时文件后替换,避免读到写了一半的清单
+        :return:
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'binary': self.binary, 'shards': self.shards,
+                       'max_face_id': self.max_face_id, 'subjects': self.subjects}, f)
+        os.replace(tmp_path, self.path)
+
+    def diff(self, data_folder_path, face_ids):
+        """
+        对比数据集与清单
+        :param data_folder_path: 文件目录
+        :param face_ids: {stu_id: face_id},当前需要训练的用户
+        :returns added,changed,removed,signatures: 新增,变化,移除的学号,当前数据的特征
+        """
+        store = FaceStore(None, data_folder_path)
+        index = store.load_index()
+        signatures = {stu_id: store.signature(stu_id, index) for stu_id in face_ids}
+        added = [stu_id for stu_id in face_ids if stu_id not in self.subjects]
+        changed = [stu_id for stu_id in face_ids if stu_id in self.subjects and (
+                self.subjects[stu_id]['face_id'] != face_ids[stu_id] or
+                self.subjects[stu_id]['signature'] != signatures[stu_id])]
+        removed = [stu_id for stu_id in self.subjects if stu_id not in face_ids]
+        return added, changed, removed, signatures
+
+    def update(self, face_ids, signatures):
+        """
+        记录已训练的用户
+        :param face_ids: {stu_id: face_id}
+        :param signatures: {stu_id: 特征}
+        :return:
+        """
+        for stu_id, face_id in face_ids.items():
+            self.subjects[stu_id] = {'face_id': face_id, 'signature': signatures[stu_id]}
+            self.max_face_id = max(self.max_face_id, face_id)
+
+
+class LBPHModel(object):
+    """
+    LBPH模型数据,与LBPHFaceRecognizer保存的YAML格式兼容,可直接增删直方图
+    """
+
+    def __init__(self, radius=1, neighbors=8, grid_x=8, grid_y=8, threshold=sys.float_info.max,
+                 histograms=None, labels=None, labels_info=None):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.threshold = threshold
+        self.histograms = histograms if histograms is not None else np.zeros((0, 0), np.float32)  # (样本数, 维度)
+        self.labels = labels if labels is not None else np.zeros(0, np.int32)  # (样本数,)
+        self.labels_info = labels_info or []  # [(label, 说明)]
+
+    @classmethod
+    def from_recognizer(cls, recognizer):
+        """
+        直接取出LBPHFaceRecognizer训练得到的直方图,无需保存后再解析
+        :param recognizer: 已训练的LBPHFaceRecognizer
+        :return model: LBPHModel
+        """
+        histograms = recognizer.getHistograms()
+        return cls(radius=recognizer.getRadius(), neighbors=recognizer.getNeighbors(), grid_x=recognizer.getGridX(),
+                   grid_y=recognizer.getGridY(), threshold=recognizer.getThreshold(),
+                   histograms=np.array(histograms, np.float32).reshape(len(histograms), -1),
+                   labels=recognizer.getLabels().ravel().astype(np.int32))
+
+    @classmethod
+    def read_yaml(cls, path):
+        """
+        读取LBPHFaceRecognizer保存的模型
+        :param path: 模型文件
+        :return model: LBPHModel
+        """
+        fs = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+        if not fs.isOpened():
+            raise FileNotFoundError(path)
+        try:
+            node = fs.getNode('opencv_lbphfaces')
+            histograms_node = node.getNode('histograms')
+            histograms = [histograms_node.at(i).mat().ravel() for i in range(histograms_node.size())]
+            labels_info_node = node.getNode('labelsInfo')
+            labels_info = [(int(labels_info_node.at(i).getNode('label').real()),
+                            labels_info_node.at(i).getNode('value').string())
+                           for i in range(labels_info_node.size())]
+            labels = node.getNode('labels').mat()
+            return cls(radius=int(node.getNode('radius').real()),
+                       neighbors=int(node.getNode('neighbors').real()),
+                       grid_x=int(node.getNode('grid_x').real()),
+                       grid_y=int(node.getNode('grid_y').real()),
+                       threshold=node.getNode('threshold').real(),
+                       histograms=np.array(histograms, np.float32).reshape(len(histograms), -1),
+                       labels=labels.ravel().astype(np.int32) if labels is not None else None,
+                       labels_info=labels_info)
+        finally:
+            fs.release()
+
+    def write_yaml(self, path):
+        """
+        写入临时文件后替换,LBPHFaceRecognizer.read可直接读取。
+        直方图以base64写入原始数据,比逐个格式化浮点数快一个数量级,且读回的数值完全一致
+        :param path: 模型文件
+        :return:
+        """
+        root, ext = os.path.splitext(path)
+        tmp_path = root + '.tmp' + ext  # 保持扩展名,FileStorage按扩展名确定格式
+        fs = cv2.FileStorage(tmp_path, cv2.FILE_STORAGE_WRITE | cv2.FILE_STORAGE_BASE64)
+        fs.startWriteStruct('opencv_lbphfaces', cv2.FileNode_MAP)
+        fs.write('threshold', float(self.threshold))
+        fs.write('radius', int(self.radius))
+        fs.write('neighbors', int(self.neighbors))
+        fs.write('grid_x', int(self.grid_x))
+        fs.write('grid_y', int(self.grid_y))
+        fs.startWriteStruct('histograms', cv2.FileNode_SEQ)
+        for histogram in self.histograms:
+            fs.write('', histogram.reshape(1, -1))
+        fs.endWriteStruct()
+        fs.write('labels', self.labels.reshape(-1, 1).astype(np.int32))
+        fs.startWriteStruct('labelsInfo', cv2.FileNode_SEQ)
+        for label, value in self.labels_info:
+            fs.startWriteStruct('', cv2.FileNode_MAP)
+            fs.write('label', int(label))
+            fs.write('value', value)
+            fs.endWriteStruct()
+        fs.endWriteStruct()
+        fs.endWriteStruct()
+        fs.release()
+        os.replace(tmp_path, path)
+
+    def remove_labels(self, labels):
+        """
+        删除指定标签的全部直方图
+        :param labels: 需要删除的标签
+        :return removed: 删除的直方图数量
+        """
+        keep = ~np.isin(self.labels, list(labels))
+        removed = int(len(self.labels) - keep.sum())
+        self.histograms = self.histograms[keep]
+        self.labels = self.labels[keep]
+        self.labels_info = [(label, value) for label, value in self.labels_info if label not in labels]
+        return removed
+
+    def extend(self, model):
+        """
+        追加另一个模型的全部直方图,两个模型的参数应相同
+        :param model: LBPHModel
+        :return:
+        """
+        self.histograms = np.concatenate([self.histograms, model.histograms]) if len(self.labels) else model.histograms
+        self.labels = np.concatenate([self.labels, model.labels])
+        self.labels_info = self.labels_info + model.labels_info
+
+    def condense(self, prototypes):
+        """
+        每个标签的直方图聚为prototypes类,每类保留离中心最近的直方图,保留的仍是真实样本,距离尺度不变
+        :param prototypes: 每个标签保留的直方图数量
+        :return kept: 保留的直方图在原模型中的下标
+        """
+        cv2.setRNGSeed(0)  # 结果可复现
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-4)
+        kept = []
+        for label in np.unique(self.labels):
+            rows = np.flatnonzero(self.labels == label)
+            if len(rows) <= prototypes:
+                kept.extend(rows)
+                continue
+            points = np.sqrt(self.histograms[rows])  # 平方根空间的欧氏距离与卡方距离相近
+            _, assignment, centers = cv2.kmeans(points, prototypes, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+            assignment = assignment.ravel()
+            for cluster, center in enumerate(centers):
+                members = np.flatnonzero(assignment == cluster)
+                if len(members):
+                    kept.append(rows[members[np.argmin(np.square(points[members] - center).sum(axis=1))]])
+        kept = np.sort(np.array(kept, dtype=np.int64))
+        self.histograms = self.histograms[kept]
+        self.labels = self.labels[kept]
+        return kept
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+from src.model import LBPHModel
+
+
+class ModelFile(object):
+    """
+    二进制模型文件:文件头(JSON),标签,直方图元素和,直方图,直方图平方根,各段按64字节对齐。
+    读取时直接内存映射,无需解析,同一台机器上的多个进程共享同一份页面
+    """
+    magic = b'LBPHBIN1'  # 文件标识及版本
+    alignment = 64  # 数据段对齐字节数
+
+    def __init__(self, header, labels, sums, histograms, roots):
+        self.header = header  # radius, neighbors, grid_x, grid_y, threshold, labels_info
+        self.labels = labels  # (样本数,) int32
+        self.sums = sums  # (样本数,) float64
+        self.histograms = histograms  # (样本数, 维度) float32
+        self.roots = roots  # (样本数, 维度) float32
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        :param model: LBPHModel
+        :return model_file: ModelFile
+        """
+        histograms = np.ascontiguousarray(model.histograms, np.float32)
+        header = {'radius': model.radius, 'neighbors': model.neighbors, 'grid_x': model.grid_x, 'grid_y': model.grid_y,
+                  'threshold': model.threshold, 'labels_info': [[int(label), value] for label, value in model.labels_info]}
+        return cls(header, np.ascontiguousarray(model.labels, np.int32), histograms.sum(axis=1, dtype=np.float64),
+                   histograms, np.sqrt(histograms))
+
+    def to_model(self):
+        """
+        :return model: LBPHModel,数据复制到内存
+        """
+        return LBPHModel(radius=self.header['radius'], neighbors=self.header['neighbors'],
+                         grid_x=self.header['grid_x'], grid_y=self.header['grid_y'],
+                         threshold=self.header['threshold'], histograms=np.array(self.histograms),
+                         labels=np.array(self.labels), labels_info=[tuple(item) for item in self.header['labels_info']])
+
+    def select(self, rows):
+        """
+        :param rows: 样本下标
+        :return model_file: 只包含指定样本的ModelFile
+        """
+        labels = self.labels[rows]
+        label_set = set(labels.tolist())
+        header = dict(self.header, labels_info=[item for item in self.header['labels_info'] if item[0] in label_set])
+        return ModelFile(header, labels, self.sums[rows], self.histograms[rows], self.roots[rows])
+
+    def sections(self):
+        """
+        :return sections: [(名称, 数组)],按写入顺序
+        """
+        return [('labels', self.labels), ('sums', self.sums), ('histograms', self.histograms), ('roots', self.roots)]
+
+    def write(self, path):
+        """
+        写入临时文件后替换,避免读到写了一半的模型
+        :param path: 模型文件
+        :return:
+        """
+        header = dict(self.header, count=len(self.labels), dim=self.histograms.shape[1], offsets={})
+        end = 0
+        for name, array in self.sections():
+            header['offsets'][name] = end  # 相对数据起始位置
+            end = self.align(end + array.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        start = self.align(len(self.magic) + 4 + len(header_bytes))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.magic + struct.pack('<I', len(header_bytes)) + header_bytes)
+            for name, array in self.sections():
+                f.seek(start + header['offsets'][name])
+                array.tofile(f)
+            f.truncate(start + end)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        内存映射读取
+        :param path: 模型文件
+        :return model_file: ModelFile,数组为只读的np.memmap
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise ValueError('not a binary model file: {}'.format(path))
+            header_size = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        start = cls.align(len(cls.magic) + 4 + header_size)
+        count, dim, offsets = header['count'], header['dim'], header['offsets']
+
+        def section(name, dtype, shape):
+            if not count:
+                return np.zeros(shape, dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=start + offsets[name], shape=shape)
+
+        return cls(header, section('labels', np.int32, (count,)), section('sums', np.float64, (count,)),
+                   section('histograms', np.float32, (count, dim)), section('roots', np.float32, (count, dim)))
+
+    @classmethod
+    def align(cls, offset):
+        return (offset + cls.alignment - 1) // cls.alignment * cls.alignment
+
+    @classmethod
+    def yaml_to_binary(cls, yaml_path, binary_path):
+        """
+        :param yaml_path: LBPHFaceRecognizer保存的模型
+        :param binary_path: 二进制模型
+        :return:
+        """
+        cls.from_model(LBPHModel.read_yaml(yaml_path)).write(binary_path)
+
+    @classmethod
+    def binary_to_yaml(cls, binary_path, yaml_path):
+        """
+        :param binary_path: 二进制模型
+        :param yaml_path: LBPHFaceRecognizer可读取的模型
+        :return:
+        """
+        cls.open(binary_path).to_model().write_yaml(yaml_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LBPH模型格式转换')
+    parser.add_argument('source', help='源文件,.yml或.bin')
+    parser.add_argument('target', help='目标文件,.yml或.bin')
+    args = parser.parse_args()
+    if args.source.endswith('.bin'):
+        ModelFile.binary_to_yaml(args.source, args.target)
+    else:
+        ModelFile.yaml_to_binary(args.source, args.target)
@@ -0,0 +1,65 @@
+import os
+import threading
+
+from src.model import TrainManifest
+
+
+class ModelWatcher(threading.Thread):
+    """
+    模型监视线程,发现新发布的模型版本后在本线程加载,加载完成再替换识别器,处理线程不等待也不会读到写了一半的模型
+    """
+
+    def __init__(self, face_process, interval=1.0, manifest_path='../recognizer/manifest.json'):
+        super(ModelWatcher, self).__init__(daemon=True)
+        self.face_process = face_process
+        self.interval = interval  # 检查间隔,单位秒
+        self.manifest_path = manifest_path
+        self.stop_event = threading.Event()
+        self.manifest_mtime = None  # 清单未修改时不重复读取
+        self.reload_event = threading.Event()  # 版本未变化也重新加载,如选择的班级变化
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                self.face_process.log_queue.put('Error: can not load the published model, retry later.')
+                self.manifest_mtime = None
+            if self.stop_event.wait(self.interval):
+                break
+
+    def check(self):
+        """
+        检查并加载新版本,首次运行时加载当前版本
+        :return:
+        """
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            mtime = 0  # 尚未训练或只有旧版本模型
+        is_reload = self.reload_event.is_set()
+        if self.face_process.model_version is not None and mtime == self.manifest_mtime and not is_reload:
+            return
+        manifest = TrainManifest(self.manifest_path)
+        manifest.load()
+        if is_reload or manifest.version != self.face_process.model_version:
+            self.reload_event.clear()  # 加载期间再次请求的重新加载不会丢失
+            try:
+                recognizer, version = self.face_process.create_recognizer()
+            except Exception:
+                if is_reload:
+                    self.reload_event.set()
+                raise
+            self.face_process.swap_recognizer(recognizer, version)
+        self.manifest_mtime = mtime
+
+    def reload(self):
+        """
+        在下次检查时重新加载当前版本
+        :return:
+        """
+        self.reload_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -0,0 +1,80 @@
+import time
+
+import cv2
+
+
+class MotionGate(object):
+    """
+    帧差运动检测,画面静止一段时间后进入空闲状态:处理线程降低帧率且不运行人脸检测,出现运动时立即恢复
+    """
+
+    def __init__(self, idle_after=3.0, idle_interval=0.2, diff_threshold=15, motion_ratio=0.005, sample_width=80):
+        self.idle_after = idle_after  # 画面静止多久后进入空闲状态,单位秒
+        self.idle_interval = idle_interval  # 空闲状态的处理间隔,单位秒
+        self.diff_threshold = diff_threshold  # 灰度变化超过该值的像素视为运动
+        self.motion_ratio = motion_ratio  # 运动像素比例超过该值视为画面有运动
+        self.sample_width = sample_width  # 帧差在缩小到该宽度的灰度图上计算
+        self.previous = None  # 上一次检查的缩小灰度图
+        self.is_idle = False
+        self.last_motion = time.time()  # 最近一次运动的时间
+        self.last_check = self.last_motion  # 最近一次检查的时间
+        self.state_start = (self.last_motion, time.process_time())  # 当前状态开始的时间及进程CPU时间
+        self.times = {True: 0.0, False: 0.0}  # 是否空闲 -> 累计时间
+        self.cpu_times = {True: 0.0, False: 0.0}  # 是否空闲 -> 累计进程CPU时间
+        self.wake_latencies = []  # 每次唤醒的延迟,单位秒
+
+    def check(self, frame, is_busy=False):
+        """
+        检查画面是否有运动并更新状态
+        :param frame: 图像帧
+        :param is_busy: 是否仍有跟踪中的人脸,有则保持活动状态
+        :return is_active: 当前帧是否需要运行人脸检测
+        """
+        now = time.time()
+        rows, cols = frame.shape[:2]
+        small = cv2.resize(frame, (self.sample_width, max(rows * self.sample_width // cols, 1)),
+                           interpolation=cv2.INTER_AREA)  # 区域平均同时抑制噪声
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        previous, self.previous = self.previous, small
+        is_moving = previous is None or previous.shape != small.shape or cv2.countNonZero(
+            cv2.threshold(cv2.absdiff(small, previous), self.diff_threshold, 255, cv2.THRESH_BINARY)[1]
+        ) > self.motion_ratio * small.size
+        last_check, self.last_check = self.last_check, now
+        if is_moving or is_busy:
+            self.last_motion = now
+            if self.is_idle:
+                # 运动发生在两次检查之间,按最长可能的延迟记录
+                self.wake_latencies.append(now - last_check)
+                self.switch(False)
+        elif not self.is_idle and now - self.last_motion >= self.idle_after:
+            self.switch(True)
+        return not self.is_idle
+
+    def switch(self, is_idle):
+        """
+        切换状态,累计上一状态的时间及CPU时间
+        :param is_idle: 是否进入空闲状态
+        :return:
+        """
+        now, cpu = time.time(), time.process_time()
+        start, start_cpu = self.state_start
+        self.times[self.is_idle] += now - start
+        self.cpu_times[self.is_idle] += cpu - start_cpu
+        self.state_start = (now, cpu)
+        self.is_idle = is_idle
+
+    def stats(self):
+        """
+        :return stats: 空闲及活动状态的时间,CPU占用(占单核的比例),唤醒次数,平均及最大唤醒延迟
+        """
+        now, cpu = time.time(), time.process_time()
+        start, start_cpu = self.state_start
+        times, cpu_times = dict(self.times), dict(self.cpu_times)
+        times[self.is_idle] += now - start
+        cpu_times[self.is_idle] += cpu - start_cpu
+        latencies = self.wake_latencies or [0.0]
+        return {'idle': times[True], 'idle_cpu': cpu_times[True] / times[True] if times[True] else 0.0,
+                'active': times[False], 'active_cpu': cpu_times[False] / times[False] if times[False] else 0.0,
+                'wakeups': len(self.wake_latencies), 'wake_ms': sum(latencies) / len(latencies) * 1000,
+                'max_wake_ms': max(latencies) * 1000}
@@ -0,0 +1,65 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+class OverlayRenderer(object):
+    """
+    文字标注,字体只加载一次,文字渲染结果按(文字,字号)缓存,直接混合到画面帧的文字区域
+    """
+
+    def __init__(self, font_path='fzqgjt.ttf', max_glyphs=256):
+        self.font_path = font_path
+        self.max_glyphs = max_glyphs  # 缓存的文字数量上限
+        self.fonts = {}  # 字号 -> 字体
+        self.glyphs = {}  # (文字, 字号) -> (透明度, x偏移, y偏移)
+
+    def font(self, size):
+        """
+        :param size: 字体大小,单位px
+        :return font: 已加载的字体
+        """
+        if size not in self.fonts:
+            self.fonts[size] = ImageFont.truetype(self.font_path, size, encoding="utf-8")  # 加载字体
+        return self.fonts[size]
+
+    def glyph(self, text, size):
+        """
+        渲染文字为透明度蒙版
+        :param text: 文字
+        :param size: 字体大小
+        :returns alpha,dx,dy: 透明度(0~1),相对绘制位置的偏移
+        """
+        key = (text, size)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            font = self.font(size)
+            left, top, right, bottom = font.getbbox(text)
+            mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+            ImageDraw.Draw(mask).text((-left, -top), text, 255, font=font)
+            alpha = np.asarray(mask, dtype=np.float32)[:, :, np.newaxis] / 255.0
+            if len(self.glyphs) >= self.max_glyphs:
+                self.glyphs.pop(next(iter(self.glyphs)))
+            glyph = self.glyphs[key] = (alpha, left, top)
+        return glyph
+
+    def draw(self, image, labels):
+        """
+        一次性绘制所有文字,只修改文字所在区域
+        :param image: BGR图像帧,原地修改
+        :param labels: [(文字, 位置, 字体大小, 颜色RGB)]
+        :return image: 添加文字的图像
+        """
+        rows, cols = image.shape[:2]
+        for text, (x, y), size, colour in labels:
+            alpha, dx, dy = self.glyph(text, size)
+            x1, y1 = x + dx, y + dy
+            x2, y2 = x1 + alpha.shape[1], y1 + alpha.shape[0]
+            # 裁剪到画面范围内
+            cx1, cy1, cx2, cy2 = max(x1, 0), max(y1, 0), min(x2, cols), min(y2, rows)
+            if cx1 >= cx2 or cy1 >= cy2:
+                continue
+            a = alpha[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1]
+            roi = image[cy1:cy2, cx1:cx2]
+            bgr = np.array(colour[::-1], dtype=np.float32)
+            roi[:] = roi * (1.0 - a) + bgr * a + 0.5
+        return image
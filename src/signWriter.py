@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+from src.database import ConnectionManager
+
+
+class SignWriter(threading.Thread):
+    """
+    签到写入线程,签到事件先入队,定期批量写入sign_db
+    """
+
+    def __init__(self, db, flush_interval=0.3):
+        super(SignWriter, self).__init__(daemon=True)
+        self.db = db
+        self.flush_interval = flush_interval  # 批量提交间隔,单位秒
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def put(self, stu_id):
+        """
+        签到事件入队,签到时间取入队时间
+        :param stu_id: 用户学号
+        :return:
+        """
+        self.queue.put((stu_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def run(self):
+        try:
+            while not (self.stop_event.is_set() and self.queue.empty()):
+                try:
+                    records = [self.queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    continue
+                # 等待一个提交间隔,收集同一批次的签到
+                deadline = time.time() + self.flush_interval
+                while not self.stop_event.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        records.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                while not self.queue.empty():
+                    records.append(self.queue.get_nowait())
+                self.flush(records)
+        finally:
+            ConnectionManager.close()  # 关闭本线程的数据库连接
+
+    def flush(self, records):
+        """
+        在一个事务中提交一批签到
+        :param records: [(stu_id, 签到时间)]
+        :return:
+        """
+        start = time.time()
+        updated = self.db.update_sign_times(records)
+        self.db.log_queue.put('Success: commit {} signs to {} in {:.1f} ms, queue depth {}.'.format(
+            len(updated), self.db.sign_db, (time.time() - start) * 1000, self.queue.qsize()))
+
+    def stop(self):
+        """
+        停止线程,队列中剩余的签到全部写入后返回
+        :return:
+        """
+        self.stop_event.set()
+        self.join()
@@ -0,0 +1,287 @@
+import time
+
+import cv2
+
+
+def iou(box1, box2):
+    """
+    计算两个人脸框的交并比
+    :param box1: (x, y, w, h)
+    :param box2: (x, y, w, h)
+    :return iou: 交并比
+    """
+    x1, y1, w1, h1 = box1
+    x2, y2, w2, h2 = box2
+    inter_w = min(x1 + w1, x2 + w2) - max(x1, x2)
+    inter_h = min(y1 + h1, y2 + h2) - max(y1, y2)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    return inter / float(w1 * h1 + w2 * h2 - inter)
+
+
+class Track(object):
+    """
+    单个跟踪目标
+    """
+
+    def __init__(self, track_id, box, template):
+        self.track_id = track_id
+        self.box = box  # 人脸位置 (x, y, w, h)
+        self.template = template  # 匹配模板,均衡化后的灰度人脸
+        self.score = 1.0  # 跟踪置信度
+
+
+class FaceTracker(object):
+    """
+    基于模板匹配的人脸跟踪,在上一次人脸框附近搜索
+    """
+
+    def __init__(self, search_margin=0.5, iou_threshold=0.3):
+        self.search_margin = search_margin  # 搜索窗口相对人脸框的外扩比例
+        self.iou_threshold = iou_threshold  # 检测结果与已有目标的匹配阈值
+        self.tracks = []
+        self.next_id = 1
+
+    def assign(self, gray, faces):
+        """
+        用检测结果更新跟踪目标,与已有目标重叠的沿用其track_id
+        :param gray: 均衡化后的灰度图
+        :param faces: 检测到的人脸位置列表
+        :return tracks: 跟踪目标列表
+        """
+        tracks = []
+        for face in faces:
+            (x, y, w, h) = face
+            matched = max(self.tracks, key=lambda t: iou(t.box, face), default=None)
+            if matched is not None and iou(matched.box, face) >= self.iou_threshold:
+                track_id = matched.track_id
+                self.tracks.remove(matched)
+            else:
+                track_id = self.next_id
+                self.next_id += 1
+            tracks.append(Track(track_id, face, gray[y:y + h, x:x + w].copy()))
+        self.tracks = tracks
+        return self.tracks
+
+    def update(self, gray):
+        """
+        在当前帧中跟踪已有目标
+        :param gray: 均衡化后的灰度图
+        :return tracks: 跟踪目标列表,score为模板匹配得分
+        """
+        rows, cols = gray.shape[:2]
+        for track in self.tracks:
+            (x, y, w, h) = track.box
+            dx, dy = int(w * self.search_margin), int(h * self.search_margin)
+            x1, y1 = max(x - dx, 0), max(y - dy, 0)
+            x2, y2 = min(x + w + dx, cols), min(y + h + dy, rows)
+            if x2 - x1 < w or y2 - y1 < h:
+                track.score = 0.0
+                continue
+            result = cv2.matchTemplate(gray[y1:y2, x1:x2], track.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (loc_x, loc_y) = cv2.minMaxLoc(result)
+            track.box = (x1 + loc_x, y1 + loc_y, w, h)
+            track.score = score
+            (x, y, w, h) = track.box
+            track.template = gray[y:y + h, x:x + w].copy()
+        return self.tracks
+
+
+class DetectionScheduler(object):
+    """
+    检测调度,每隔detect_interval帧检测一次,其余帧跟踪
+    """
+
+    def __init__(self, detect_interval=5, min_track_score=0.6):
+        self.detect_interval = detect_interval  # 检测间隔帧数,1为每帧检测
+        self.min_track_score = min_track_score  # 跟踪置信度低于该值视为跟丢,当前帧立即重新检测
+        self.frames_since_detect = 0
+        self.detect_frames = 0  # 检测帧数
+        self.track_frames = 0  # 跟踪帧数
+
+    def need_detect(self, tracker):
+        """
+        :param tracker: FaceTracker
+        :return need_detect: 当前帧是否需要运行检测
+        """
+        return not tracker.tracks or self.frames_since_detect + 1 >= self.detect_interval
+
+    def is_lost(self, tracks):
+        """
+        :param tracks: 跟踪后的目标
+        :return is_lost: 是否有目标跟丢
+        """
+        return any(track.score < self.min_track_score for track in tracks)
+
+    def record(self, source):
+        """
+        记录当前帧人脸框来源
+        :param source: detect 或 track
+        :return:
+        """
+        if source == 'detect':
+            self.frames_since_detect = 0
+            self.detect_frames += 1
+        else:
+            self.frames_since_detect += 1
+            self.track_frames += 1
+
+    def stats(self):
+        """
+        :return stats: 检测帧数,跟踪帧数
+        """
+        return {'detect': self.detect_frames, 'track': self.track_frames}
+
+
+class DetectionRegion(object):
+    """
+    检测区域:在固定区域内,以上次检测到的人脸为中心搜索,未检测到时逐次扩大,每隔若干次检测扫描一次整个固定区域
+    """
+
+    def __init__(self, roi=None, margin=1.0, growth=1.5, full_scan_interval=10):
+        self.roi = roi  # 固定区域(x, y, w, h),相对画面宽高的比例,None为全画面
+        self.margin = margin  # 搜索区域相对人脸框的外扩比例
+        self.growth = growth  # 未检测到人脸时外扩比例的增长倍数
+        self.full_scan_interval = full_scan_interval  # 每隔多少次检测扫描一次整个固定区域,1为每次都扫描
+        self.faces = []  # 上次检测到的人脸位置
+        self.expand = margin  # 当前外扩比例
+        self.scans = 0  # 距上次扫描整个固定区域的检测次数
+        self.is_full = True  # 当前区域是否为整个固定区域
+        self.full_scans = 0  # 扫描整个固定区域的次数
+        self.scanned_pixels = 0  # 检测的像素数
+        self.frame_pixels = 0  # 画面的像素数
+
+    def bounds(self, shape):
+        """
+        :param shape: 画面尺寸
+        :return bounds: 固定区域(x, y, w, h),单位像素
+        """
+        rows, cols = shape[:2]
+        if self.roi is None:
+            return 0, 0, cols, rows
+        x, y, w, h = self.roi
+        x1, y1 = min(max(int(x * cols), 0), cols - 1), min(max(int(y * rows), 0), rows - 1)
+        return x1, y1, min(int((x + w) * cols), cols) - x1, min(int((y + h) * rows), rows) - y1
+
+    def next(self, shape):
+        """
+        确定本次检测的区域,每张人脸一个搜索区域,重叠的区域合并
+        :param shape: 画面尺寸
+        :return regions: [(x, y, w, h)],单位像素
+        """
+        bx, by, bw, bh = self.bounds(shape)
+        self.scans += 1
+        regions = [(bx, by, bx + bw, by + bh)]
+        if self.faces and self.scans < self.full_scan_interval:
+            windows = []
+            for (x, y, w, h) in self.faces:
+                dx, dy = int(w * self.expand), int(h * self.expand)
+                window = [max(x - dx, bx), max(y - dy, by), min(x + w + dx, bx + bw), min(y + h + dy, by + bh)]
+                if window[2] <= window[0] or window[3] <= window[1]:
+                    continue
+                # 与已有区域重叠时合并,合并后可能又与其他区域重叠
+                while True:
+                    overlapped = [other for other in windows if other[0] < window[2] and window[0] < other[2] and
+                                  other[1] < window[3] and window[1] < other[3]]
+                    if not overlapped:
+                        break
+                    for other in overlapped:
+                        windows.remove(other)
+                        window = [min(window[0], other[0]), min(window[1], other[1]),
+                                  max(window[2], other[2]), max(window[3], other[3])]
+                windows.append(window)
+            if windows and sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in windows) < bw * bh:
+                regions = windows
+        regions = [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in regions]
+        self.is_full = regions == [(bx, by, bw, bh)]
+        if self.is_full:
+            self.scans = 0
+            self.full_scans += 1
+        self.scanned_pixels += sum(w * h for (x, y, w, h) in regions)
+        self.frame_pixels += shape[0] * shape[1]
+        return regions
+
+    def update(self, faces):
+        """
+        记录检测结果
+        :param faces: 检测到的人脸位置列表
+        :return:
+        """
+        if faces:
+            self.faces = list(faces)
+            self.expand = self.margin
+        elif self.is_full:
+            self.faces = []  # 整个固定区域都没有人脸
+        else:
+            self.expand *= self.growth
+
+    def stats(self):
+        """
+        :return stats: 检测像素占画面的比例,扫描整个固定区域的次数
+        """
+        return {'scanned': self.scanned_pixels / max(self.frame_pixels, 1), 'full_scans': self.full_scans}
+
+
+class IdentityCache(object):
+    """
+    跟踪目标的身份缓存,同一目标在有效期内不重复识别
+    """
+
+    def __init__(self, ttl=2.0, min_iou=0.5):
+        self.ttl = ttl  # 缓存有效期,单位秒
+        self.min_iou = min_iou  # 人脸框相对识别时位置的最小交并比,低于该值视为漂移
+        self.entries = {}  # track_id -> (face_id, confidence, 识别时人脸框, 识别时间)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, track_id, box):
+        """
+        查询跟踪目标的身份
+        :param track_id: 跟踪目标编号
+        :param box: 当前人脸框
+        :returns face_id,confidence: 缓存的识别结果,未命中时为None
+        """
+        entry = self.entries.get(track_id)
+        if entry is not None:
+            face_id, confidence, cached_box, cached_time = entry
+            if time.time() - cached_time <= self.ttl and iou(cached_box, box) >= self.min_iou:
+                self.hits += 1
+                return face_id, confidence
+            del self.entries[track_id]
+        self.misses += 1
+        return None
+
+    def put(self, track_id, box, face_id, confidence, confirmed):
+        """
+        缓存识别结果,未确认的结果不缓存,下一帧重新识别
+        :param track_id: 跟踪目标编号
+        :param box: 人脸框
+        :param face_id: 识别结果
+        :param confidence: 置信度
+        :param confirmed: 是否确认为已知用户
+        :return:
+        """
+        if confirmed:
+            self.entries[track_id] = (face_id, confidence, box, time.time())
+        else:
+            self.entries.pop(track_id, None)
+
+    def retain(self, track_ids):
+        """
+        清除已丢失目标的缓存
+        :param track_ids: 仍在跟踪的目标编号
+        :return:
+        """
+        for track_id in list(self.entries):
+            if track_id not in track_ids:
+                del self.entries[track_id]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        :return stats: 命中次数,未命中次数
+        """
+        return {'hits': self.hits, 'misses': self.misses}
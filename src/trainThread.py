@@ -0,0 +1,44 @@
+import threading
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from src.database import ConnectionManager
+
+
+class TrainThread(QThread):
+    """
+    后台训练线程,训练进度通过日志队列输出,可随时取消;也用于从模型中删除用户。
+    多个线程之间由训练锁串行执行
+    """
+    trained_signal = pyqtSignal(bool)  # 训练结束信号,是否训练或删除成功
+
+    def __init__(self, face_process, incremental=True, removed=None):
+        super(TrainThread, self).__init__()
+        self.face_process = face_process
+        self.incremental = incremental  # 是否增量训练
+        self.removed = removed  # 需要从模型中删除的学号,不为空时只删除不训练
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        try:
+            if self.removed:
+                is_trained = self.face_process.remove_subjects(self.removed)
+            else:
+                is_trained = self.face_process.train(self.incremental, self.cancel_event)
+        finally:
+            ConnectionManager.close()  # 关闭本线程的数据库连接
+        self.trained_signal.emit(is_trained)
+
+    def cancel(self):
+        """
+        取消训练,当前批次完成后停止,已保存的模型不受影响
+        :return:
+        """
+        self.cancel_event.set()
+
+    def start_low_priority(self):
+        """
+        以低优先级启动,不影响界面及实时识别
+        :return:
+        """
+        self.start(QThread.LowPriority)
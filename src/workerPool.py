@@ -0,0 +1,148 @@
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# 检测识别进程异常退出
+class WorkerDied(Exception):
+    pass
+
+
+def detect_worker(task_queue, result_queue, log_queue, shm_name, frame_shape, slot_count, active_classes=None):
+    """
+    检测识别进程,每个进程持有独立的级联分类器及识别器
+    :param task_queue: 任务队列,(帧序号, 缓冲槽)
+    :param result_queue: 结果队列,(帧序号, 缓冲槽, 识别结果)
+    :param log_queue: 日志队列
+    :param shm_name: 共享内存名称
+    :param frame_shape: 图像帧尺寸
+    :param slot_count: 缓冲槽数量
+    :param active_classes: 参与识别的班级,None为全部
+    :return:
+    """
+    from src.faceProcess import FaceProcess
+
+    face_process = FaceProcess(log_queue)
+    face_process.active_classes = active_classes
+    face_process.start_model_watcher()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((slot_count,) + tuple(frame_shape), dtype=np.uint8, buffer=shm.buf)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, slot = task
+            try:
+                results = face_process.recognize_frame(frames[slot])
+                results = [(tuple(int(v) for v in face), face_id, float(confidence))
+                           for face, face_id, confidence in results]
+            except Exception as e:
+                log_queue.put('Error: worker failed to process frame {}.'.format(seq))
+                results = []
+            result_queue.put((seq, slot, results))
+    finally:
+        if face_process.model_watcher:
+            face_process.model_watcher.stop()
+        del frames
+        shm.close()
+
+
+class DetectionPool(object):
+    """
+    检测识别进程池,图像帧经共享内存传递,结果按帧序号重新排序
+    """
+
+    def __init__(self, workers, frame_shape, log_queue, active_classes=None):
+        self.workers = workers
+        self.frame_shape = tuple(frame_shape)
+        self.log_queue = log_queue
+        self.active_classes = active_classes  # 参与识别的班级,None为全部
+        self.slot_count = workers * 2  # 缓冲槽数量
+        self.seq = 0  # 已提交的帧序号
+        self.next_seq = 1  # 下一个应返回的帧序号
+        self.pending = {}  # 已完成但未按顺序返回的结果
+        self.free_slots = list(range(self.slot_count))
+        self.dropped = 0  # 没有空闲缓冲槽而丢弃的帧数
+
+        slot_bytes = int(np.prod(self.frame_shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.slot_count)
+        self.frames = np.ndarray((self.slot_count,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=detect_worker, daemon=True,
+                                                  args=(self.task_queue, self.result_queue, log_queue,
+                                                        self.shm.name, self.frame_shape, self.slot_count,
+                                                        active_classes))
+                          for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.log_queue.put('Success: start {} detection workers.'.format(workers))
+
+    def in_flight(self):
+        """
+        :return count: 已提交但未返回的帧数
+        """
+        return self.slot_count - len(self.free_slots)
+
+    def submit(self, frame):
+        """
+        复制图像帧到共享内存并提交
+        :param frame: 图像帧
+        :return seq: 帧序号,没有空闲缓冲槽时为None
+        """
+        if not self.free_slots:
+            self.dropped += 1
+            return None
+        slot = self.free_slots.pop()
+        np.copyto(self.frames[slot], frame)
+        self.seq += 1
+        self.task_queue.put((self.seq, slot))
+        return self.seq
+
+    def get(self, block=True, timeout=None):
+        """
+        按帧序号顺序取回结果
+        :param block: 是否等待
+        :param timeout: 等待时间,None为一直等待,期间检测进程退出时抛出WorkerDied
+        :returns seq,frame,results: 帧序号,图像帧,识别结果;暂无结果时为None
+        """
+        while self.next_seq not in self.pending:
+            if self.next_seq > self.seq:
+                return None
+            try:
+                seq, slot, results = self.result_queue.get(block=block, timeout=1 if timeout is None else timeout)
+            except queue.Empty:
+                # 进程退出时其正在处理的帧不会返回,之后的帧会一直等待
+                dead = [process.pid for process in self.processes if not process.is_alive()]
+                if dead:
+                    raise WorkerDied('detection workers {} exited'.format(dead))
+                if block and timeout is None:
+                    continue
+                return None
+            self.pending[seq] = (slot, results)
+        slot, results = self.pending.pop(self.next_seq)
+        seq = self.next_seq
+        self.next_seq += 1
+        frame = self.frames[slot].copy()
+        self.free_slots.append(slot)
+        return seq, frame, results
+
+    def close(self):
+        """
+        停止进程并释放共享内存
+        :return:
+        """
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+        self.log_queue.put('detection workers stopped, {} frames dropped.'.format(self.dropped))